@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for machammer. These use the fixtures in fixtures/
+and run on any platform.
+
+    python bench.py [benchmark ...]
+"""
+
+import os
+import sys
+import time
+import shelve
+import plistlib
+import resource
+import datetime
+import tempfile
+import multiprocessing
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, n=100, *args):
+    """Return best per-call time of func in seconds."""
+    best = None
+
+    for _ in range(3):
+        start = time.time()
+        for _ in range(n):
+            func(*args)
+        t = (time.time() - start) / n
+        best = t if best is None else min(best, t)
+
+    return best
+
+
+def report(name, seconds):
+    print('%-48s %10.3f ms' % (name, seconds * 1000))
+
+
+def fixture_items(dt, scale=1):
+    with open(os.path.join(FIXTURES, 'SP%sDataType.xml' % dt), 'rb') as f:
+        return plistlib.load(f)[0]['_items'] * scale
+
+
+def _shelve_get(path, dt):
+    shelf = shelve.open(path)
+    try:
+        return shelf.get(dt)
+    finally:
+        shelf.close()
+
+
+def _shelve_set(path, dt, data):
+    shelf = shelve.open(path)
+    shelf['expires'] = time.time()
+    shelf[dt] = data
+    shelf.close()
+
+
+def _readers(args):
+    kind, root, n = args
+    from machammer.cache import FileCache
+    cache = FileCache(root)
+    errors = 0
+    for _ in range(n):
+        try:
+            if kind == 'shelve':
+                _shelve_get(os.path.join(root, 'Network.shelf'), 'Network')
+            else:
+                cache.get('Network')
+        except Exception:
+            errors += 1
+    return errors
+
+
+@benchmark
+def cache():
+    """system_profiler cache backends: shelve vs FileCache"""
+    from machammer import system_profiler
+    from machammer.cache import FileCache
+
+    root = tempfile.mkdtemp()
+    data = fixture_items('Network', 500)
+    fc = FileCache(root)
+    fc.set('Network', data)
+    shelf = os.path.join(root, 'Network.shelf')
+    _shelve_set(shelf, 'Network', data)
+
+    report('cold hit, shelve', timed(_shelve_get, 100, shelf, 'Network'))
+    report('cold hit, FileCache', timed(fc.get, 100, 'Network'))
+
+    system_profiler.cache = fc
+    system_profiler._profiles['Network'] = (time.time() + 60, data)
+    report('warm hit, shelve', timed(_shelve_get, 100, shelf, 'Network'))
+    report('warm hit, system_profiler', timed(system_profiler._cache_get, 1000, 'Network'))
+
+    for kind in ('shelve', 'filecache'):
+        pool = multiprocessing.Pool(8)
+        start = time.time()
+        errors = sum(pool.map(_readers, [(kind, root, 50)] * 8))
+        pool.close()
+        report('8 concurrent readers x 50, %s (%d errors)' % (kind, errors),
+               time.time() - start)
+
+
+def applications_fixture(n=20000):
+    """Write a synthetic SPApplicationsDataType profile with n apps."""
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    items = [{'_name': 'App %d' % i,
+              'version': '1.%d' % i,
+              'path': '/Applications/App %d.app' % i,
+              'obtained_from': 'identified_developer',
+              'lastModified': datetime.datetime(2018, 1, 1),
+              'signed_by': ['Developer ID Application: Example (XXXXXXXXXX)',
+                            'Developer ID Certification Authority',
+                            'Apple Root CA'],
+              'has64BitIntelCode': 'yes',
+              'info': 'App %d version 1.%d, Copyright 2018 Example' % (i, i)}
+             for i in range(n)]
+
+    with os.fdopen(fd, 'wb') as f:
+        plistlib.dump([{'_dataType': 'SPApplicationsDataType', '_items': items}], f)
+
+    return path
+
+
+def _child(q, func, args):
+    start = time.time()
+    func(*args)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    rss /= 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    q.put((time.time() - start, rss))
+
+
+def _peak(func, *args):
+    """Run func in a child process, return (seconds, peak RSS in MB).
+    func must be picklable (a module level function), macOS spawns."""
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_child, args=(q, func, args))
+    p.start()
+    result = q.get()
+    p.join()
+    return result
+
+
+def _full(path):
+    with open(path, 'rb') as f:
+        items = plistlib.load(f)[0]['_items']
+    return [x for x in items if x['_name'] == 'App 12345']
+
+
+def _stream(path):
+    from machammer.plist import iterparse
+    with open(path, 'rb') as f:
+        return [x for _, x in iterparse(f) if x['_name'] == 'App 12345']
+
+
+@benchmark
+def stream():
+    """Full plistlib load vs streaming iterparse() of Applications"""
+    path = applications_fixture()
+    print('fixture is %.1f MB' % (os.path.getsize(path) / 1024.0 / 1024))
+
+    for name, func in (('baseline', len), ('plistlib', _full), ('iterparse', _stream),):
+        t, rss = _peak(func, path)
+        print('%-48s %10.3f s %8.1f MB peak RSS' % (name, t, rss))
+
+    os.unlink(path)
+
+
+@benchmark
+def index():
+    """Linear scans vs indexed SystemProfile.find() for 500 app names"""
+    from machammer import system_profiler
+    from machammer.system_profiler import SystemProfile, _indexes
+
+    system_profiler.PROFILER_PATH = os.path.join(FIXTURES, 'system_profiler')
+    items = [{'_name': 'App %d' % i, 'path': '/Applications/App %d.app' % i}
+             for i in range(20000)]
+    names = ['App %d' % i for i in range(0, 20000, 40)]
+
+    def linear():
+        for n in names:
+            [x for x in items if n in x['_name']]
+
+    def indexed(match):
+        _indexes.clear()
+        p = SystemProfile('Applications', items)
+        for n in names:
+            p.find('_name', n, match)
+
+    report('linear substring scan', timed(linear, 1))
+    report('indexed exact (incl. build)', timed(indexed, 1, 'exact'))
+    report('indexed startswith (incl. build)', timed(indexed, 1, 'startswith'))
+    report('indexed contains (incl. build)', timed(indexed, 1, 'contains'))
+
+
+@benchmark
+def dscl():
+    """Creating 100 users: dscl per command vs users.create_users()"""
+    from unittest import mock
+    from machammer import users, runner, instrument
+
+    class StubRunner(runner.SubprocessRunner):
+        """Run dscl (the stand-in), skip ditto and chown"""
+        def run(self, argv, input=None, capture=True):
+            if argv[0] == users.DSCL_PATH:
+                return runner.SubprocessRunner.run(self, argv, input, capture)
+            return runner.Result(argv, 0, b'', b'')
+
+    def legacy(accounts):
+        for a in accounts:
+            path = '/Users/' + a['realname'].lower().replace(' ', '.')
+            users.dscl('create', path)
+            users.dscl('create', path, 'RealName', a['realname'])
+            users.dscl('create', path, 'UniqueID', users.nextid())
+            users.dscl('create', path, 'PrimaryGroupID', 20)
+            users.dscl('create', path, 'UserShell', '/bin/bash')
+            users.dscl('create', path, 'NFSHomeDirectory', path)
+            users.dscl('passwd', path, a['password'])
+
+    users.DSCL_PATH = os.path.join(FIXTURES, 'dscl')
+    accounts = [{'realname': 'Lab User %d' % i, 'password': 'secret'} for i in range(100)]
+
+    for name, func in (('dscl per command', legacy), ('create_users', users.create_users)):
+        os.environ['MH_DSCL_DB'] = os.path.join(tempfile.mkdtemp(), 'db.json')
+        # only the dscl stand-in runs, no need to be root
+        with runner.use(StubRunner()), mock.patch.object(os, 'getuid', lambda: 0):
+            with instrument.enabled() as stats:
+                start = time.time()
+                func(accounts)
+                t = time.time() - start
+        n = len([c for c in stats.commands if c.binary == 'dscl'])
+        report('%s (%d dscl processes)' % (name, n), t)
+
+
+@benchmark
+def segments():
+    """Segmented downloads from a server throttled to 4 MB/s per connection"""
+    sys.path.append(FIXTURES)
+    import server
+    from machammer.download import Downloader
+
+    size = 16 * 1024 * 1024
+    srv = server.serve({'/big.dmg': os.urandom(size)}, rate=4 * 1024 * 1024)
+
+    for n in (1, 2, 4, 8):
+        d = Downloader(tempfile.mkdtemp())
+        start = time.time()
+        d.get(srv.url + '/big.dmg', segments=n)
+        t = time.time() - start
+        print('%-48s %10.3f s %8.1f MB/s' % ('%d segment(s)' % n, t, size / t / 1024 / 1024))
+
+    srv.shutdown()
+
+
+@benchmark
+def hashing():
+    """SHA-256 of a 256 MB file: 64k reads vs 4 MB readinto vs mmap vs index"""
+    import hashlib
+    from machammer import integrity
+
+    size = 256 * 1024 * 1024
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        for _ in range(size // (16 * 1024 * 1024)):
+            f.write(os.urandom(16 * 1024 * 1024))
+
+    def small_reads():
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+
+    index = integrity.Index(tempfile.mkdtemp())
+    index.digest(path)
+
+    for name, func in (('64k reads', small_reads),
+                       ('4 MB readinto', lambda: integrity.hash_file(path, use_mmap=False)),
+                       ('mmap', lambda: integrity.hash_file(path)),
+                       ('indexed (unchanged file)', lambda: index.digest(path)),):
+        t = timed(func, 1)
+        print('%-48s %10.3f s %8.1f MB/s' % (name, t, size / t / 1024 / 1024))
+
+    os.unlink(path)
+
+
+@benchmark
+def plists():
+    """Reading 500 Info.plists: spawning a process each vs in-process vs memo"""
+    from machammer import functions
+
+    root = tempfile.mkdtemp()
+    paths = []
+
+    for i in range(500):
+        path = os.path.join(root, '%d.plist' % i)
+        fmt = plistlib.FMT_BINARY if i % 2 else plistlib.FMT_XML
+        with open(path, 'wb') as f:
+            plistlib.dump({'CFBundleIdentifier': 'com.example.app%d' % i,
+                           'CFBundleShortVersionString': '1.%d' % i,
+                           'CFBundleDocumentTypes': [{'CFBundleTypeName': 'Document'}] * 10}, f, fmt=fmt)
+        paths.append(path)
+
+    # plutil where we have it, otherwise cat shows the cost of the spawn alone
+    tool = ['/usr/bin/plutil', '-convert', 'xml1', '-o', '-'] if os.path.exists('/usr/bin/plutil') else ['/bin/cat']
+
+    def spawn():
+        import subprocess
+        for p in paths:
+            plistlib.loads(subprocess.check_output(tool + [p]))
+
+    functions.get_plists(paths, cache=True)
+    report('%s per file' % os.path.basename(tool[0]), timed(spawn, 1))
+    report('get_plists()', timed(functions.get_plists, 1, paths))
+    report('get_plists(cache=True), unchanged', timed(lambda: functions.get_plists(paths, cache=True), 1))
+
+
+@benchmark
+def inventory():
+    """Inventory of 3000 app bundles: serial vs threaded scan vs rescan"""
+    from machammer import apps, functions
+
+    root = tempfile.mkdtemp()
+
+    for i in range(3000):
+        folder = os.path.join(root, 'Folder %d' % (i % 10) if i % 3 else '', 'App %d.app' % i, 'Contents')
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'Info.plist'), 'wb') as f:
+            plistlib.dump({'CFBundleIdentifier': 'com.example.app%d' % i,
+                           'CFBundleShortVersionString': '1.%d' % i,
+                           'CFBundleDocumentTypes': [{'CFBundleTypeName': 'Document'}] * 10}, f)
+
+    def cold(workers):
+        functions._plists.clear()
+        apps.inventory([root], workers)
+
+    report('1 worker', timed(cold, 1, 1))
+    report('8 workers', timed(cold, 1, 8))
+    report('rescan, nothing changed', timed(apps.inventory, 1, [root]))
+
+
+@benchmark
+def osascript():
+    """100 scripts: a process per script vs one session (stand-in interpreter)"""
+    import subprocess
+    from machammer import applescript
+
+    argv = [os.path.join(FIXTURES, 'osascript')]
+    request = b'{"id": 1, "script": "return 1"}\n'
+
+    def spawn():
+        for _ in range(100):
+            subprocess.run(argv, input=request, stdout=subprocess.PIPE)
+
+    def session():
+        with applescript.Session(argv) as s:
+            for _ in range(100):
+                s.run('return 1')
+
+    report('process per script', timed(spawn, 1))
+    report('session', timed(session, 1))
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('%s: %s' % (name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""A local HTTP server for testing downloads.
+
+Serves the files in a dict {path: bytes} with ETags, Last-Modified,
+conditional GETs and Range requests. It can also be made to drop
+connections part way through and to throttle each connection.
+
+    server = serve({'/big.dmg': data}, drop_after=1000000, drops=2)
+    url = server.url + '/big.dmg'
+    ...
+    server.shutdown()
+"""
+
+import time
+import hashlib
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+LAST_MODIFIED = 'Thu, 01 Mar 2018 12:00:00 GMT'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers.items())))
+        data = server.files.get(self.path)
+
+        if data is None:
+            return self.send_error(404)
+
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start, end, status = 0, len(data) - 1, 200
+        r = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+
+        if r and (if_range is None or if_range in (etag, LAST_MODIFIED)):
+            first, last = r.split('=')[1].split('-')
+            start = int(first)
+            end = int(last) if last else end
+            status = 206
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.end_headers()
+                return
+
+        body = data[start:end + 1]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        self.end_headers()
+
+        with server.lock:
+            drop = server.drops > 0
+            server.drops -= 1
+
+        limit = server.drop_after if drop else len(body)
+        sent = 0
+
+        while sent < min(limit, len(body)):
+            chunk = body[sent:min(limit, sent + 65536)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if server.rate:
+                time.sleep(len(chunk) / float(server.rate))
+
+        if drop:
+            self.close_connection = True
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(files, drop_after=0, drops=0, rate=0):
+    """Start serving files on a random local port in a thread."""
+    server = Server(('127.0.0.1', 0), Handler)
+    server.files = files
+    server.drop_after = drop_after
+    server.drops = drops
+    server.rate = rate
+    server.requests = []
+    server.lock = threading.Lock()
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""asyncio versions of the helpers in machammer.functions.
+
+They take the same arguments and raise the same errors, but don't
+block the event loop:
+
+    from machammer import aio
+    names = await asyncio.gather(*[aio.check_output('/bin/hostname') for _ in range(100)])
+
+Commands run with asyncio subprocesses. If a recording or replaying
+runner is in use, it is called in a worker thread instead so those
+keep working.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import subprocess
+from contextlib import asynccontextmanager
+
+from .. import runner, instrument, applescript
+from ..functions import curl_args
+
+
+async def run(argv, input=None, capture=True):
+    """Async counterpart of runner.run()."""
+    argv = [str(x) for x in argv]
+    current = runner.get_runner()
+    stats = instrument.stats
+    start = time.time()
+
+    if type(current) is not runner.SubprocessRunner:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, current.run, argv, input, capture)
+    else:
+        pipe = subprocess.PIPE if capture else None
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=None if input is None else subprocess.PIPE,
+            stdout=pipe,
+            stderr=pipe)
+
+        try:
+            out, err = await proc.communicate(input)
+        except asyncio.CancelledError:
+            # don't leave the command running (or a zombie) behind
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
+
+        result = runner.Result(argv, proc.returncode, out, err)
+
+    if stats is not None:
+        stats.add(argv, time.time() - start, result.returncode)
+
+    return result
+
+
+async def call(*args):
+    """Async counterpart of functions.call."""
+    return (await run(args, capture=False)).returncode
+
+
+async def popen(cmd, input=None):
+    """Async counterpart of functions.popen."""
+    result = await run(cmd, input)
+
+    if result.stderr:
+        raise Exception(result.stderr)
+
+    return result.stdout
+
+
+async def check_output(*args):
+    """Async counterpart of functions.check_output."""
+    r = await run(args)
+
+    if r.returncode != 0:
+        raise subprocess.CalledProcessError(r.returncode, r.argv, r.stdout)
+
+    result = r.stdout.strip()
+
+    if len(result) < 1:
+        result = None
+
+    return result
+
+
+async def osascript(s):
+    try:
+        return await check_output('/usr/bin/osascript', '-e', s)
+    except Exception as e:
+        raise Exception('The AppleScript returned an error: %s' % e)
+
+
+async def tell_app(app, s):
+    return await osascript('tell application %s to %s' % (applescript.quote(app), s))
+
+
+@asynccontextmanager
+async def fetch(url, *args):
+    """Async counterpart of functions.fetch.
+
+    > async with aio.fetch(url, '-L') as path:
+    """
+    args, path, tmp = curl_args(url, args)
+    await call('/usr/bin/curl', *args)
+
+    try:
+        yield path
+    finally:
+        if tmp:
+            os.unlink(path)
+            logging.debug('Deleted tempfile %s' % path)
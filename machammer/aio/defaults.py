@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""asyncio versions of machammer.defaults."""
+
+import plistlib
+
+from . import call, check_output
+from ..defaults import DEFAULTS_PATH, parse_domains
+
+
+async def defaults(*args):
+    if any(i == 'read' for i in args):
+        return await check_output(DEFAULTS_PATH, *args)
+
+    return await call(DEFAULTS_PATH, *args)
+
+
+async def get(*args):
+    return await defaults('read', *args)
+
+
+async def set(*args):
+    return await defaults('write', *args)
+
+
+async def delete(*args):
+    return await defaults('delete', *args)
+
+
+async def domains(*args):
+    return parse_domains(await check_output(DEFAULTS_PATH, 'domains'))
+
+
+async def as_dict(domain):
+    s = await check_output(DEFAULTS_PATH, 'export', domain, '-')
+    return plistlib.loads(s)
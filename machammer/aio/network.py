@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""asyncio versions of machammer.network."""
+
+import os
+import asyncio
+
+from . import check_output, system_profiler
+from .. import network
+
+
+async def networksetup(*args):
+    return await check_output('/usr/sbin/networksetup', *args)
+
+
+async def systemsetup(*args):
+    return await check_output('/usr/sbin/systemsetup', *args)
+
+
+async def _profile():
+    return (await system_profiler.load(['Network']))['Network']
+
+
+async def get_ports(type='Ethernet'):
+    """Return all devices of type (Ethernet, AirPort)"""
+    return [i for i in await _profile() if i.get('type') == type]
+
+
+async def set_wifi_power(on=True):
+    """Set AirPort power to on (True) or off (False)"""
+    state = 'on' if on else 'off'
+    ports = await get_ports('AirPort')
+    await asyncio.gather(*[networksetup('-setairportpower', i['interface'], state)
+                           for i in ports])
+    network.invalidate()
+
+
+async def get_wifi_power():
+    """Get AirPort power state."""
+    ports = await get_ports('AirPort')
+    results = await asyncio.gather(*[networksetup('-getairportpower', i['interface'])
+                                     for i in ports])
+    return 'On' in [network.parse_power(r) for r in results]
+
+
+async def _route():
+    try:
+        return network.parse_route(await check_output('/sbin/route', '-n', 'get', 'default'))
+    except Exception:
+        # no default route
+        return None
+
+
+async def _ifconfig():
+    return network.parse_ifconfig(await check_output('/sbin/ifconfig') or b'')
+
+
+async def _computer_name():
+    return (await networksetup('-getcomputername') or b'').decode()
+
+
+async def snapshot(ttl=0):
+    """Async counterpart of network.snapshot, shares its last
+    Snapshot. The commands it needs run concurrently."""
+    if os.path.isdir(network.SYS_NET):
+        # read from /sys and /proc, nothing to wait for
+        return network.snapshot(ttl)
+
+    s = network.recent(ttl)
+
+    if s is not None:
+        return s
+
+    items, active, primary, name = await asyncio.gather(_profile(), _ifconfig(), _route(), _computer_name())
+    ports = network.parse_ports(items)
+    power = await asyncio.gather(*[networksetup('-getairportpower', p.interface)
+                                   for p in ports if p.type == 'AirPort'])
+    wifi = any(network.parse_power(r) == 'On' for r in power)
+    return network.remember(ports, active, primary, wifi, name)
+
+
+async def get_primary(port=None, ttl=network.TTL):
+    """Return device node of primary network interface"""
+    primary = (await snapshot(ttl)).primary
+    return primary == port if port else primary
+
+
+async def is_wired(primary=False, ttl=network.TTL):
+    """Do we have an "active" Ethernet connection?
+    With primary=True, is it the primary interface?"""
+    s = await snapshot(ttl)
+    ports = [p.interface for p in s.ports if p.type == 'Ethernet']
+
+    if primary:
+        return s.primary in ports
+
+    return any(s.active.get(p) for p in ports)
+
+
+async def is_wireless(ttl=network.TTL):
+    return not await is_wired(ttl=ttl)
+
+
+async def get_computer_name():
+    """Return the Computer Name of this Mac"""
+    return await networksetup('-getcomputername')
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""asyncio versions of machammer.system_profiler."""
+
+from . import check_output
+from .. import system_profiler
+
+
+async def load(types):
+    """Async counterpart of system_profiler.load: return {type: items},
+    running system_profiler once for the types that aren't cached.
+    The results go in the same cache."""
+    results = {}
+    missing = []
+
+    for dt in types:
+        items = system_profiler.cached(dt)
+        if items is None:
+            missing.append(dt)
+        else:
+            results[dt] = items
+
+    if missing:
+        try:
+            xml = await check_output(system_profiler.PROFILER_PATH, *system_profiler.profiler_args(missing))
+        except Exception as e:
+            raise Exception('Failed to fetch system profile: %s' % e)
+
+        for dt, items in system_profiler.parse_xml(xml, missing).items():
+            system_profiler.store(dt, items)
+            results[dt] = items
+
+    return results
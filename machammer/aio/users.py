@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""asyncio versions of the read-only parts of machammer.users."""
+
+import plistlib
+
+from . import check_output
+from .. import users
+
+
+async def dscl(*args):
+    return await check_output(users.DSCL_PATH, '.', *args)
+
+
+async def get_info(username):
+    """Return info about a user"""
+    s = await check_output(users.DSCL_PATH, '-plist', '.', 'read', '/Users/' + username)
+    return plistlib.loads(s)
+
+
+async def get_ids(node='/Users', attr='UniqueID'):
+    """Return all IDs in use for DS node/attribute."""
+    return users.parse_ids(await dscl('-list', node, attr))
+
+
+async def nextid(node='/Users', attr='UniqueID'):
+    """Return next available ID for DS node/attribute."""
+    ids = users.IdAllocator(node, attr)
+    ids.refresh(await get_ids(node, attr))
+    return ids.next()
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""Run many AppleScripts through one osascript process.
+
+Starting osascript takes a good while, which adds up when scripts poll
+System Events in a loop. A Session keeps one osascript running a small
+JavaScript server that compiles and runs the scripts it is sent:
+
+    with applescript.session():
+        while not process.is_running('Finder'):
+            ...
+
+While a session is in use, functions.osascript (and everything built
+on it) goes through it. Requests and responses are single lines of
+JSON. If a script takes longer than timeout, the osascript process is
+killed and a new one started for the next script.
+
+Statements for apps whose results aren't needed can be deferred; they
+are sent together before the next script runs, with consecutive
+statements for the same app in one tell block:
+
+    s.defer('Safari', 'quit')
+    s.defer('Mail', 'quit')
+    s.flush()
+
+A Batch sends several statements to one app as a single script, with
+or without a session, and gives each statement its own result
+(see functions.applescript_batch).
+"""
+
+import os
+import json
+import time
+import select
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from . import instrument
+
+OSASCRIPT_PATH = '/usr/bin/osascript'
+
+SERVER = r'''
+ObjC.import('Foundation');
+
+function value(d) {
+    if (d.descriptorType == 0x6c697374) {  // 'list'
+        var items = [];
+        for (var i = 1; i <= d.numberOfItems; i++)
+            items.push(value(d.descriptorAtIndex(i)));
+        return items;
+    }
+    var s = d.stringValue;
+    return s.isNil() ? null : s.js;
+}
+
+function send(response) {
+    var s = $.NSString.alloc.initWithUTF8String(JSON.stringify(response) + '\n');
+    $.NSFileHandle.fileHandleWithStandardOutput.writeData(s.dataUsingEncoding($.NSUTF8StringEncoding));
+}
+
+function handle(request) {
+    var error = Ref();
+    var script = $.NSAppleScript.alloc.initWithSource(request.script);
+    var result = script.executeAndReturnError(error);
+
+    if (result.isNil())
+        return {id: request.id, error: error[0].objectForKey('NSAppleScriptErrorMessage').js};
+
+    return {id: request.id, result: value(result)};
+}
+
+function run() {
+    var stdin = $.NSFileHandle.fileHandleWithStandardInput;
+    var buffer = '';
+
+    while (true) {
+        var data = stdin.availableData;
+        if (data.length == 0)
+            return;
+        // requests are ASCII, so chunks can't split a character
+        buffer += $.NSString.alloc.initWithDataEncoding(data, $.NSASCIIStringEncoding).js;
+
+        for (var i = buffer.indexOf('\n'); i >= 0; i = buffer.indexOf('\n')) {
+            send(handle(JSON.parse(buffer.slice(0, i))));
+            buffer = buffer.slice(i + 1);
+        }
+    }
+}
+'''
+
+
+class ScriptError(Exception):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+def quote(s):
+    """Return s as an AppleScript string literal."""
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def literal(value):
+    """Return Python value as an AppleScript literal."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return 'missing value'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ', '.join(literal(x) for x in value)
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%s:%s' % (k, literal(v)) for k, v in sorted(value.items()))
+    return quote(str(value))
+
+
+def tell(app, statements):
+    """Return script that sends statements to app in one tell block."""
+    return '\n'.join(['tell application %s' % quote(app)] +
+                     ['    ' + s for s in statements] +
+                     ['end tell'])
+
+
+SEPARATOR = '\x1e'
+
+STATEMENT = """    try
+        %s
+        set end of _results to "ok:"
+    on error _e
+        set end of _results to "error:" & _e
+    end try"""
+
+EXPRESSION = """    try
+        set end of _results to "ok:" & ((%s) as text)
+    on error _e
+        set end of _results to "error:" & _e
+    end try"""
+
+
+class Result(object):
+    """Outcome of a statement in a Batch: value is the text it
+    returned, error the error message if it failed."""
+    def __init__(self, statement):
+        self.statement = statement
+        self.value = None
+        self.error = None
+
+    def __repr__(self):
+        return '<Result %s: %r>' % (self.statement, self.error or self.value)
+
+
+class Batch(object):
+    """Statements for app, sent as one script by send().
+
+    execute is called with the script and returns its output as text.
+    Arguments to run() and get() are formatted into the statement
+    (with %) as AppleScript literals, so they need no quoting. Every
+    statement runs even if earlier ones fail; send() raises
+    ScriptError for the first one that did, if raise_errors.
+    """
+    def __init__(self, app, execute, raise_errors=True):
+        self.app = app
+        self.execute = execute
+        self.raise_errors = raise_errors
+        self.items = []
+
+    def _add(self, template, statement, args):
+        if args:
+            statement = statement % tuple(literal(a) for a in args)
+        result = Result(statement)
+        self.items.append((template % statement, result))
+        return result
+
+    def run(self, statement, *args):
+        """Add a command, its Result has no value."""
+        return self._add(STATEMENT, statement, args)
+
+    def get(self, expression, *args):
+        """Add an expression, its Result has the value as text."""
+        return self._add(EXPRESSION, expression, args)
+
+    @property
+    def script(self):
+        return '\n'.join(['set _results to {}',
+                           'tell application %s' % quote(self.app)] +
+                          [s for s, _ in self.items] +
+                          ['end tell',
+                           'set AppleScript\'s text item delimiters to character id 30',
+                           'return _results as text'])
+
+    def send(self):
+        """Run the statements, return their Results."""
+        if not self.items:
+            return []
+
+        output = self.execute(self.script) or ''
+        results = [r for _, r in self.items]
+        lines = output.split(SEPARATOR)
+        self.items = []
+
+        if len(lines) != len(results):
+            raise ScriptError('Expected %d results, got: %s' % (len(results), output))
+
+        for r, line in zip(results, lines):
+            status, value = line.split(':', 1)
+            if status == 'ok':
+                r.value = value
+            else:
+                r.error = value
+
+        failed = [r for r in results if r.error is not None]
+
+        if failed and self.raise_errors:
+            raise ScriptError('%s failed: %s' % (failed[0].statement, failed[0].error))
+
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+
+
+class Session(object):
+    """One osascript process running scripts sent to it.
+
+    argv is the command that starts the server (a stand-in can be
+    used for testing), timeout the default seconds a script may take.
+    """
+    def __init__(self, argv=None, timeout=60):
+        self.argv = argv or [OSASCRIPT_PATH, '-l', 'JavaScript', '-e', SERVER]
+        self.timeout = timeout
+        self.proc = None
+        self.buffer = b''
+        self.last = 0
+        self.deferred = []
+        self.lock = threading.RLock()
+
+    def start(self):
+        if self.proc is None:
+            logging.debug('Starting osascript session')
+            self.proc = subprocess.Popen(self.argv, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, bufsize=0)
+            self.buffer = b''
+            instrument.count('applescript.start')
+
+    def close(self):
+        with self.lock:
+            if self.deferred:
+                self.flush()
+            self._stop()
+
+    def _stop(self):
+        if self.proc is None:
+            return
+
+        proc, self.proc = self.proc, None
+        proc.stdin.close()
+
+        try:
+            proc.wait(1)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+        proc.stdout.close()
+
+    def _readline(self, deadline):
+        fd = self.proc.stdout.fileno()
+
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise Timeout('No response from osascript')
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ScriptError('osascript session ended')
+            self.buffer += chunk
+
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def _request(self, script, timeout):
+        self.start()
+        self.last += 1
+        request = json.dumps({'id': self.last, 'script': script}) + '\n'
+
+        try:
+            self.proc.stdin.write(request.encode('ascii'))
+            response = self._readline(time.time() + (timeout or self.timeout))
+        except (Timeout, ScriptError, IOError, OSError):
+            # the process is in an unknown state, start over next time
+            self._stop()
+            raise
+
+        if response.get('id') != self.last:
+            self._stop()
+            raise ScriptError('Out of sync with osascript session')
+
+        if 'error' in response:
+            raise ScriptError(response['error'])
+
+        return response.get('result')
+
+    def run(self, script, timeout=None):
+        """Run AppleScript source script, return its result: text,
+        list for AppleScript lists, None if there was no result."""
+        with self.lock:
+            if self.deferred:
+                self.flush()
+            with instrument.timed('applescript.run'):
+                return self._request(script, timeout)
+
+    def tell(self, app, statement, timeout=None):
+        return self.run('tell application %s to %s' % (quote(app), statement), timeout)
+
+    def defer(self, app, statement):
+        """Send statement to app along with the other deferred
+        statements, before the next script runs or on flush()."""
+        with self.lock:
+            self.deferred.append((app, statement))
+
+    def flush(self, timeout=None):
+        """Send the deferred statements as one script."""
+        with self.lock:
+            blocks = []
+
+            for app, statement in self.deferred:
+                if blocks and blocks[-1][0] == app:
+                    blocks[-1][1].append(statement)
+                else:
+                    blocks.append((app, [statement]))
+
+            self.deferred = []
+
+            if blocks:
+                self._request('\n'.join(tell(app, s) for app, s in blocks), timeout)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+_session = None
+
+
+def get_session():
+    """Return the Session in use, None if there is none."""
+    return _session
+
+
+@contextmanager
+def use(session):
+    """Run functions.osascript through session in the with block."""
+    global _session
+    previous, _session = _session, session
+
+    try:
+        yield session
+    finally:
+        _session = previous
+
+
+@contextmanager
+def session(argv=None, timeout=60):
+    """Start a Session and use it for the duration of the with block."""
+    with Session(argv, timeout) as s:
+        with use(s):
+            yield s
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Inventory of installed applications.
+
+Much faster than the Applications system_profiler type: the bundles are
+found with scandir and their Info.plists read in-process on a thread
+pool. The plists are cached by functions.get_plists, so a rescan only
+reads the bundles that changed:
+
+    for app in apps.inventory():
+        print(app.identifier, app.version)
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from . import functions
+
+ROOTS = ('/Applications',)
+DEPTH = 2
+
+
+class Bundle(object):
+    def __init__(self, path, plist):
+        self.path = path
+        self.plist = plist
+        self.name = os.path.basename(path)[:-4]
+        self.identifier = plist.get('CFBundleIdentifier')
+        self.version = plist.get('CFBundleShortVersionString')
+        self.build = plist.get('CFBundleVersion')
+
+    def __repr__(self):
+        return '<Bundle %s %s>' % (self.identifier, self.version)
+
+
+def find_bundles(roots=ROOTS, depth=DEPTH):
+    """Yield paths of the .app bundles in roots and up to depth
+    folders below them (e.g. /Applications/Utilities)."""
+    stack = [(root, 0) for root in roots]
+
+    while stack:
+        path, level = stack.pop()
+
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            continue
+
+        for e in entries:
+            if e.name.startswith('.') or not e.is_dir():
+                continue
+            if e.name.endswith('.app'):
+                yield e.path
+            elif level < depth:
+                stack.append((e.path, level + 1))
+
+
+def read_bundle(path):
+    """Return Bundle for the app at path, None if it has no Info.plist."""
+    info = os.path.join(path, 'Contents', 'Info.plist')
+
+    try:
+        return Bundle(path, functions.get_plists([info], cache=True)[info])
+    except OSError:
+        return None
+    except Exception as e:
+        logging.debug('Failed to read %s: %s' % (info, e))
+        return None
+
+
+def inventory(roots=ROOTS, max_workers=8):
+    """Return list of Bundles of the apps in roots, sorted by path."""
+    paths = sorted(find_bundles(roots))
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        return [b for b in pool.map(read_bundle, paths) if b]
+
+
+def find(identifier, roots=ROOTS):
+    """Return the Bundles with CFBundleIdentifier identifier."""
+    return [b for b in inventory(roots) if b.identifier == identifier]
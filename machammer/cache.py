@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""A small on-disk cache with atomic writes and cross-process locking.
+
+Every key is stored in its own file. Writes go to a temporary file
+in the same directory which is then renamed over the old entry, so
+readers never see a partial write and need no locking.
+
+The cache lives in a shared temporary directory, so entries are
+stored as plists (loading them can't run code) and are only read if
+they and the cache directory belong to us and aren't writable by
+anyone else. If the directory can't be used, nothing is cached.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import logging
+import plistlib
+import tempfile
+from contextlib import contextmanager
+
+VERSION = 2
+
+
+def default_root():
+    """Return the per-user cache directory."""
+    name = 'machammer-%d' % os.getuid()
+    return os.path.join(tempfile.gettempdir(), name, 'v%d' % VERSION)
+
+
+def is_private(st):
+    """True if stat result st is ours and not group/other writable."""
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+class FileCache(object):
+    """Cache values in root, one file per key. Values must be
+    plist types (so no None).
+
+    ttl is the default lifetime in seconds. ttls maps keys to their own
+    lifetime. Entries older than their ttl, but younger than ttl + stale,
+    are still returned by get(..., stale=True) so the caller can serve
+    them while refreshing.
+    """
+    def __init__(self, root=None, ttl=3600, ttls=None, stale=0):
+        self.root = root or default_root()
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.stale = stale
+
+    def _mkroot(self):
+        """Create root, return False if it can't be used."""
+        try:
+            os.makedirs(self.root, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                logging.warning('Not caching in %s: %s' % (self.root, e))
+                return False
+
+        if not is_private(os.lstat(self.root)):
+            logging.warning('Not caching in %s, it is not ours' % self.root)
+            return False
+
+        return True
+
+    def path(self, key):
+        return os.path.join(self.root, '%s.cache' % key)
+
+    def get_ttl(self, key):
+        return self.ttls.get(key, self.ttl)
+
+    def get(self, key, stale=False):
+        """Return (value, fresh) for key, or None on a miss."""
+        try:
+            if not is_private(os.lstat(self.root)):
+                logging.warning('Ignoring cache directory %s, it is not ours' % self.root)
+                return None
+            fd = os.open(self.path(key), os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+            with os.fdopen(fd, 'rb') as f:
+                if not is_private(os.fstat(fd)):
+                    logging.warning('Ignoring cache entry %s, it is not ours' % self.path(key))
+                    return None
+                entry = plistlib.load(f)
+        except Exception:
+            return None
+
+        if entry.get('version') != VERSION or entry.get('key') != key:
+            return None
+
+        age = time.time() - entry['created']
+        ttl = self.get_ttl(key)
+
+        if 0 <= age < ttl:
+            return (entry['value'], True)
+
+        if stale and 0 <= age < ttl + self.stale:
+            return (entry['value'], False)
+
+    def set(self, key, value):
+        """Atomically replace the entry for key."""
+        if not self._mkroot():
+            return
+
+        entry = {'version': VERSION, 'key': key,
+                 'created': time.time(), 'value': value}
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.%s.' % key)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                plistlib.dump(entry, f, fmt=plistlib.FMT_BINARY)
+            os.rename(tmp, self.path(key))
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    @contextmanager
+    def lock(self, *keys):
+        """Hold an exclusive lock on keys (for writers).
+
+        Locks are always taken in sorted order to avoid deadlocks.
+        Without a usable cache directory nothing is locked.
+        """
+        keys = sorted(set(keys)) if self._mkroot() else []
+        files = []
+
+        try:
+            for key in keys:
+                f = open(os.path.join(self.root, '%s.lock' % key), 'a')
+                files.append(f)
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+        finally:
+            for f in reversed(files):
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
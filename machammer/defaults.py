@@ -1,9 +1,37 @@
 # -*- coding: utf-8 -*-
+"""Read and write preferences.
 
+get(), set() and delete() run /usr/bin/defaults for every key. To
+change many keys, use a Domain: it reads the domain's plist once and
+writes all changes back in one go:
+
+    with defaults.Domain('com.apple.dock') as dock:
+        dock['autohide'] = True
+        dock['tilesize'] = 36
+
+A transaction does the same for several domains (or plist paths) and
+puts back what was there if any of them can't be written:
+
+    with defaults.transaction() as t:
+        t.set('com.apple.dock', 'autohide', True)
+        t.domain('/Library/LaunchDaemons/com.example.foo').update(Label='com.example.foo')
+
+apply() takes the settings a machine should have and only writes the
+ones that differ:
+
+    changes = defaults.apply({'com.apple.dock': {'autohide': True}})
+"""
+
+import os
+import sys
 import plistlib
-from .functions import call, check_output
+import tempfile
+
+from .functions import call, check_output, popen
 
 DEFAULTS_PATH = '/usr/bin/defaults'
+PREFERENCES_DIR = os.path.expanduser('~/Library/Preferences')
+GLOBAL_DOMAINS = ('NSGlobalDomain', '-g', '-globalDomain')
 
 
 def defaults(*args):
@@ -25,11 +53,382 @@ def delete(*args):
     return defaults('delete', *args)
 
 
+def parse_domains(s):
+    return [i.strip() for i in s.decode().split(',')]
+
+
 def domains(*args):
-    s = check_output(DEFAULTS_PATH, 'domains').decode()
-    return [i.strip() for i in s.split(',')]
+    return parse_domains(check_output(DEFAULTS_PATH, 'domains'))
 
 
 def as_dict(domain):
     s = check_output(DEFAULTS_PATH, 'export', domain, '-')
-    return plistlib.loads(s)
+    return plistlib.loads(s) if s else {}
+
+
+def domain_path(domain):
+    """Return path to the plist of domain, like defaults does:
+    absolute paths are used as is, names are looked up in
+    PREFERENCES_DIR."""
+    if domain in GLOBAL_DOMAINS:
+        domain = '.GlobalPreferences'
+
+    if not domain.startswith('/'):
+        domain = os.path.join(PREFERENCES_DIR, domain)
+
+    if not domain.endswith('.plist'):
+        domain += '.plist'
+
+    return domain
+
+
+def read_plist(path):
+    """Return (contents, format) of plist at path, ({}, None) if
+    there is no such file."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return {}, None
+
+    fmt = plistlib.FMT_BINARY if data.startswith(b'bplist') else plistlib.FMT_XML
+    return plistlib.loads(data), fmt
+
+
+def _replace(path, data, mode, owner=None):
+    """Atomically replace the file at path with bytes data and give
+    it mode and owner (uid, gid)."""
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.plist', dir=os.path.dirname(path))
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        if owner and owner != (st.st_uid, st.st_gid):
+            # e.g. root writing a user's preferences
+            os.chown(tmp, *owner)
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def write_plist(path, data, fmt=None):
+    """Atomically replace the plist at path with data, keeping the
+    file's mode and owner. New files are written in binary format."""
+    try:
+        st = os.stat(path)
+        mode, owner = st.st_mode & 0o7777, (st.st_uid, st.st_gid)
+    except OSError:
+        mode, owner = 0o644, None
+
+    _replace(path, plistlib.dumps(data, fmt=fmt or plistlib.FMT_BINARY), mode, owner)
+
+
+def flush():
+    """Make cfprefsd re-read preferences from disk after
+    their plists have been written directly.
+
+    cfprefsd can't be told to drop a single domain, so this restarts
+    every cfprefsd on the machine (or all of the user's, when not run
+    as root). Write all domains first, then flush once."""
+    if sys.platform == 'darwin':
+        call('/usr/bin/killall', 'cfprefsd')
+
+
+_deleted = object()
+
+
+class Domain(object):
+    """Preferences of domain, read once and written back with save().
+
+    Changes are kept in memory until save(), which merges them into
+    what is on disk at that moment, writes the plist once and flushes
+    cfprefsd. Used as a context manager, changes are saved when the
+    block exits without an exception.
+    """
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or domain_path(name)
+        self._data = None
+        self._fmt = None
+        self._changes = {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data, self._fmt = read_plist(self.path)
+        return self._data
+
+    def __getitem__(self, key):
+        value = self._changes.get(key, self.data.get(key, _deleted))
+
+        if value is _deleted:
+            raise KeyError(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._changes[key] = _deleted
+
+    def __contains__(self, key):
+        return self._changes.get(key, self.data.get(key, _deleted)) is not _deleted
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        # set() is defaults.set() in here
+        keys = list(self.data) + [k for k in self._changes if k not in self.data]
+        return [k for k in keys if k in self]
+
+    def as_dict(self):
+        return dict((k, self[k]) for k in self.keys())
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    @property
+    def changes(self):
+        """{key: value} of unsaved changes, deleted keys map to None."""
+        return dict((k, None if v is _deleted else v) for k, v in self._changes.items())
+
+    def discard(self):
+        self._changes.clear()
+
+    def save(self):
+        """Write changes to disk, return True if there were any."""
+        if not self._write():
+            return False
+
+        if self.cached:
+            flush()
+
+        return True
+
+    def _write(self):
+        if not self._changes:
+            return False
+
+        data, fmt = read_plist(self.path)
+
+        for k, v in self._changes.items():
+            if v is _deleted:
+                data.pop(k, None)
+            else:
+                data[k] = v
+
+        write_plist(self.path, data, fmt or self._fmt)
+        self._data, self._fmt = data, fmt or self._fmt
+        self._changes.clear()
+
+        return True
+
+    @property
+    def cached(self):
+        """True if cfprefsd caches this domain (unlike e.g. launchd plists)."""
+        return '/Preferences/' in self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.save()
+
+    def __repr__(self):
+        return '<Domain %s>' % self.name
+
+
+class Transaction(object):
+    """Changes to several domains, saved together with commit().
+
+    Every plist is written once. If one of them fails, the ones
+    already written are restored and the error is raised.
+    """
+    def __init__(self):
+        self.domains = {}
+        self.order = []
+
+    def domain(self, name):
+        """Return the Domain name in this transaction."""
+        path = domain_path(name)
+
+        if path not in self.domains:
+            self.domains[path] = Domain(name, path)
+            self.order.append(path)
+
+        return self.domains[path]
+
+    def set(self, domain, key, value):
+        self.domain(domain)[key] = value
+
+    def delete(self, domain, key):
+        del self.domain(domain)[key]
+
+    def commit(self):
+        """Save all domains, return list of those that changed."""
+        saved = []
+
+        try:
+            for path in self.order:
+                d = self.domains[path]
+                if d._changes:
+                    saved.append((d, backup(path)))
+                    d._write()
+        except Exception:
+            for d, b in reversed(saved):
+                restore(d.path, b)
+            self.rollback()
+            raise
+
+        if any(d.cached for d, _ in saved):
+            flush()
+
+        return [d for d, _ in saved]
+
+    def rollback(self):
+        """Forget all changes."""
+        for d in self.domains.values():
+            d.discard()
+            d._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+def transaction():
+    return Transaction()
+
+
+def backup(path):
+    """Return (contents, mode, owner) of the file at path, None if
+    there is none."""
+    try:
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            return f.read(), st.st_mode & 0o7777, (st.st_uid, st.st_gid)
+    except (IOError, OSError):
+        return None
+
+
+def restore(path, saved):
+    """Put back a file saved with backup()."""
+    if saved is None:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+
+    _replace(path, *saved)
+
+
+class Change(object):
+    def __init__(self, domain, key, old, new):
+        self.domain = domain
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return '<Change %s %s: %r -> %r>' % (self.domain, self.key, self.old, self.new)
+
+
+def same(a, b):
+    """True if plist values a and b are equal, types included
+    (1, 1.0 and True are different things in a plist)."""
+    if type(a) is not type(b):
+        return False
+
+    if isinstance(a, dict):
+        return sorted(a) == sorted(b) and all(same(a[k], b[k]) for k in a)
+
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+
+    return a == b
+
+
+def diff(domain, current, wanted):
+    """Return list of Changes that turn current into wanted.
+    A value of None in wanted means the key should not exist."""
+    changes = []
+
+    for key in sorted(wanted):
+        old, new = current.get(key), wanted[key]
+        if new is None and key not in current:
+            continue
+        if key not in current or not same(old, new):
+            changes.append(Change(domain, key, old, new))
+
+    return changes
+
+
+def plist_literal(value):
+    """Return value as a property list fragment, the form defaults
+    write takes values of any type in."""
+    xml = plistlib.dumps(value).decode()
+    return xml[xml.index('<plist version="1.0">') + 21:xml.rindex('</plist>')].strip()
+
+
+def apply(settings, files=False, dry_run=False):
+    """Make domains match settings ({domain: {key: value}}) and
+    return the list of Changes made. Keys that already have the
+    right value are left alone.
+
+    Domains are read with as_dict(), then each changed key is written
+    (or deleted) with its own defaults command, so keys that others
+    change meanwhile are kept. With files=True the plists are read and
+    written directly, in one transaction.
+    """
+    t = transaction() if files else None
+    changes = []
+
+    for domain in sorted(settings):
+        d = t.domain(domain) if files else None
+        current = d.as_dict() if files else as_dict(domain)
+        found = diff(domain, current, settings[domain])
+        changes += found
+
+        if not found or dry_run:
+            continue
+
+        if files:
+            for c in found:
+                if c.new is None:
+                    del d[c.key]
+                else:
+                    d[c.key] = c.new
+            continue
+
+        for c in found:
+            if c.new is None:
+                popen([DEFAULTS_PATH, 'delete', domain, c.key])
+            else:
+                popen([DEFAULTS_PATH, 'write', domain, c.key, plist_literal(c.new)])
+
+    if files and not dry_run:
+        t.commit()
+
+    return changes
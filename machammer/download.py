@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""A caching download manager for functions.fetch.
+
+Downloads are stored by their SHA-256 digest, so the same installer is
+only downloaded once no matter how many scripts ask for it. Known URLs
+are revalidated with their ETag/Last-Modified, interrupted downloads
+are resumed with Range requests and every download is hashed while it
+is written.
+
+    path = download.get_downloader().get(url, sha256='...')
+
+Large files can be fetched over several connections at once with
+segments=N, if the server supports Range requests.
+"""
+
+import os
+import socket
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+    from http.client import HTTPException
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+    from httplib import HTTPException
+
+from .cache import FileCache, default_root
+from .integrity import ChecksumError, get_index
+
+CHUNK = 1024 * 1024
+
+
+class PrefixHasher(object):
+    """Hash a file that is written out of order.
+
+    Writers report the byte ranges they have written with add(); the
+    ranges are hashed (read back with pread) as soon as they become
+    part of the contiguous prefix of the file.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.h = hashlib.sha256()
+        self.done = 0
+        self.ranges = {}
+        self.lock = threading.Lock()
+
+    def add(self, start, end):
+        with self.lock:
+            self.ranges[start] = end
+
+            while self.done in self.ranges:
+                end = self.ranges.pop(self.done)
+                while self.done < end:
+                    chunk = os.pread(self.fd, min(CHUNK, end - self.done), self.done)
+                    self.h.update(chunk)
+                    self.done += len(chunk)
+
+    def hexdigest(self):
+        return self.h.hexdigest()
+
+
+def validators(headers):
+    """Return the ETag/Last-Modified of headers that are set."""
+    v = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+    return dict((k, x) for k, x in v.items() if x is not None)
+
+
+def preallocate(fd, size):
+    if size <= 0:
+        return  # posix_fallocate() fails with EINVAL for 0 bytes
+
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, 0, size)
+    else:
+        os.ftruncate(fd, size)
+
+
+class Downloader(object):
+    """Download URLs into a content-addressed cache in root.
+
+    retries is how many times a dropped download is resumed before
+    giving up, max_workers limits get_many().
+    """
+    def __init__(self, root=None, max_workers=4, retries=3, timeout=60):
+        self.root = root or os.path.join(default_root(), 'downloads')
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        self.meta = FileCache(os.path.join(self.root, 'meta'), ttl=float('inf'))
+
+    def _dir(self, name):
+        path = os.path.join(self.root, name)
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path, 0o700)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+        return path
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest)
+
+    def partial_path(self, key):
+        return os.path.join(self._dir('partial'), key)
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def get(self, url, sha256=None, segments=1):
+        """Return path to the cached download of url.
+
+        If sha256 is given and we already have that content, nothing
+        is downloaded. Otherwise the download must match it.
+        With segments > 1 the file is downloaded in that many byte
+        ranges in parallel (falling back to one stream if the server
+        can't do ranges).
+        The returned file is shared, don't modify it.
+        """
+        sha256 = sha256 and sha256.lower()
+
+        if sha256 and os.path.exists(self.object_path(sha256)):
+            return self.object_path(sha256)
+
+        key = self.key(url)
+
+        with self.meta.lock(key):
+            hit = self.meta.get(key)
+            meta = hit[0] if hit else None
+
+            if meta and not os.path.exists(self.object_path(meta['sha256'])):
+                meta = None
+
+            if meta and sha256 and meta['sha256'] != sha256:
+                # don't revalidate what we have, it's not what was asked for
+                meta = None
+
+            if segments > 1:
+                path = self._download_segments(url, key, meta, sha256, segments)
+                if path is not None:
+                    return path
+
+            attempt = 0
+
+            while True:
+                try:
+                    return self._download(url, key, meta, sha256)
+                except (HTTPException, socket.error, IOError) as e:
+                    if isinstance(e, HTTPError) or attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    logging.debug('Download of %s failed (%s), resuming' % (url, e))
+
+    def get_many(self, urls, sha256s=None, segments=1):
+        """Download urls in parallel, return their paths in order."""
+        sha256s = sha256s or [None] * len(urls)
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = [pool.submit(self.get, u, s, segments) for u, s in zip(urls, sha256s)]
+            return [f.result() for f in futures]
+
+    def _probe(self, url):
+        """Return (size, validator, headers) if url can be fetched
+        in ranges, otherwise None."""
+        try:
+            resp = urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=self.timeout)
+        except HTTPError as e:
+            # e.g. 416 for an empty file, the single stream will tell
+            logging.debug('Probing %s failed: %s' % (url, e))
+            return None
+
+        resp.close()
+        total = (resp.headers.get('Content-Range') or '').split('/')[-1]
+
+        if resp.getcode() != 206 or not total.isdigit():
+            return None
+
+        validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+        return int(total), validator, resp.headers
+
+    def _download_segments(self, url, key, meta, sha256, segments):
+        probe = self._probe(url)
+
+        if probe is None:
+            logging.debug('%s does not support ranges' % url)
+            return None
+
+        size, validator, headers = probe
+
+        unchanged = meta and validator and validator in (meta.get('etag'), meta.get('last_modified'))
+
+        if unchanged and (not sha256 or meta['sha256'] == sha256):
+            logging.debug('%s not modified' % url)
+            return self.object_path(meta['sha256'])
+
+        partial = self.partial_path(key) + '.segments'
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        try:
+            preallocate(fd, size)
+            hasher = PrefixHasher(fd)
+            step = max(-(-size // segments), 1)
+            ranges = [(i, min(i + step, size)) for i in range(0, size, step)]
+
+            with ThreadPoolExecutor(len(ranges) or 1) as pool:
+                futures = [pool.submit(self._segment, url, validator, fd, start, end, hasher)
+                           for start, end in ranges]
+                for f in futures:
+                    f.result()
+        except Exception:
+            os.unlink(partial)
+            raise
+        finally:
+            os.close(fd)
+
+        if hasher.done != size:
+            os.unlink(partial)
+            raise IOError('Hashed %d of %d bytes of %s' % (hasher.done, size, url))
+
+        return self._store(url, key, partial, hasher.hexdigest(), sha256, headers)
+
+    def _segment(self, url, validator, fd, start, end, hasher):
+        """Download bytes start..end of url straight into fd."""
+        view = memoryview(bytearray(CHUNK))
+        pos = start
+        attempt = 0
+
+        while pos < end:
+            headers = {'Range': 'bytes=%d-%d' % (pos, end - 1)}
+            if validator:
+                headers['If-Range'] = validator
+
+            try:
+                resp = urlopen(Request(url, headers=headers), timeout=self.timeout)
+
+                try:
+                    if resp.getcode() != 206:
+                        raise Exception('%s changed while downloading' % url)
+
+                    while pos < end:
+                        n = resp.readinto(view[:min(CHUNK, end - pos)])
+                        if not n:
+                            break
+                        os.pwrite(fd, view[:n], pos)
+                        hasher.add(pos, pos + n)
+                        pos += n
+                finally:
+                    resp.close()
+
+                if pos < end:
+                    raise IOError('Connection closed at %d of %d-%d' % (pos, start, end))
+            except (HTTPException, socket.error, IOError) as e:
+                if isinstance(e, HTTPError) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logging.debug('Segment %d-%d of %s failed (%s), resuming' % (start, end, url, e))
+
+    def _download(self, url, key, meta, sha256):
+        partial = self.partial_path(key)
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {}
+
+        if offset:
+            hit = self.meta.get(key + '.partial')
+            validator = hit and (hit[0].get('etag') or hit[0].get('last_modified'))
+            if validator:
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = validator
+            else:
+                offset = 0
+        elif meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            resp = urlopen(Request(url, headers=headers), timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                logging.debug('%s not modified' % url)
+                return self.object_path(meta['sha256'])
+            if e.code == 416:
+                # whatever we had is no good
+                os.unlink(partial)
+                raise IOError('Invalid range, restarting download of %s' % url)
+            raise
+
+        h = hashlib.sha256()
+
+        if resp.getcode() == 206:
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK), b''):
+                    h.update(chunk)
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            self.meta.set(key + '.partial', validators(resp.headers))
+
+        length = resp.headers.get('Content-Length')
+        received = 0
+
+        try:
+            with open(partial, mode) as f:
+                for chunk in iter(lambda: resp.read(CHUNK), b''):
+                    f.write(chunk)
+                    h.update(chunk)
+                    received += len(chunk)
+        finally:
+            resp.close()
+
+        if length is not None and received < int(length):
+            raise IOError('Connection closed after %d of %s bytes' % (received, length))
+
+        return self._store(url, key, partial, h.hexdigest(), sha256, resp.headers)
+
+    def _store(self, url, key, partial, digest, sha256, headers):
+        """Move a finished download into the cache."""
+        if sha256 and digest != sha256:
+            os.unlink(partial)
+            raise ChecksumError('Checksum mismatch for %s: expected %s, got %s' % (url, sha256, digest))
+
+        self._dir('objects')
+        path = self.object_path(digest)
+        os.rename(partial, path)
+        meta = validators(headers)
+        meta.update(url=url, sha256=digest, size=os.path.getsize(path))
+        self.meta.set(key, meta)
+        self.meta.delete(key + '.partial')
+        get_index().record(path, digest)
+        logging.debug('Downloaded %s to %s' % (url, path))
+        return path
+
+
+_downloader = None
+
+
+def get_downloader():
+    """Return the shared Downloader."""
+    global _downloader
+
+    if _downloader is None:
+        _downloader = Downloader()
+
+    return _downloader
@@ -8,19 +8,58 @@ import tempfile
 import subprocess
 from contextlib import contextmanager
 
+from . import runner, instrument, applescript
+from .download import get_downloader
+from .integrity import verify
 from .system_profiler import SystemProfile
 
 
 SERVICEDIR = '/Library/Services'
 
 
+_plists = {}
+
+
 def get_plist(path):
     """Return plist dict regardless of format.
+
+    XML and binary plists are parsed in-process, anything else
+    (e.g. old-style ASCII plists) is converted with plutil first.
+    Returns None if plutil has no output.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return plistlib.load(f)
+    except plistlib.InvalidFileException:
+        plist = check_output('/usr/bin/plutil', '-convert', 'xml1', path, '-o', '-')
+        return plistlib.loads(plist) if plist else None
+
+
+def get_plists(paths, cache=False):
+    """Return {path: plist} for all paths.
+
+    With cache=True results are remembered by (path, mtime, size) and
+    only re-read when the file changes. Cached dicts are shared, so
+    don't modify them.
     """
-    plist = subprocess.check_output(['/usr/bin/plutil',
-                                     '-convert', 'xml1',
-                                     path, '-o', '-'])
-    return plistlib.readPlistFromString(plist)
+    results = {}
+
+    for path in paths:
+        if not cache:
+            results[path] = get_plist(path)
+            continue
+
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        hit = _plists.get(path)
+
+        if hit is None or hit[0] != key:
+            instrument.count('functions.plist_miss')
+            hit = _plists[path] = (key, get_plist(path))
+
+        results[path] = hit[1]
+
+    return results
 
 
 def call(*args):
@@ -28,28 +67,27 @@ def call(*args):
 
     > call('ls', '/Users')
     """
-    args = [str(x) for x in args]
-    subprocess.call(args)
+    return runner.run(args, capture=False).returncode
 
 
 def popen(cmd, input=None):
     """Shortcut for Popen/communicate()."""
-    proc = subprocess.Popen(cmd,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (res, err) = proc.communicate(input)
+    result = runner.run(cmd, input)
 
-    if err:
-        raise Exception(err)
+    if result.stderr:
+        raise Exception(result.stderr)
 
-    return res
+    return result.stdout
 
 
 def check_output(*args):
     """Shortcut for subprocess.check_output."""
-    args = [str(x) for x in args]
-    result = subprocess.check_output(args).strip()
+    r = runner.run(args)
+
+    if r.returncode != 0:
+        raise subprocess.CalledProcessError(r.returncode, r.argv, r.stdout)
+
+    result = r.stdout.strip()
 
     if len(result) < 1:
         result = None
@@ -67,11 +105,9 @@ def display_notification(msg, title='', subtitle=''):
 
     display_notification('Mymessage')
     """
-    msg = msg.replace('"', '\\"')
-    title = title.replace('"', '\\"')
-    subtitle = subtitle.replace('"', '\\"')
-    cmd = 'display notification "{0}" with title "{1}" subtitle "{2}"'
-    osascript(cmd.format(msg, title, subtitle))
+    quote = applescript.quote
+    cmd = 'display notification %s with title %s subtitle %s'
+    osascript(cmd % (quote(msg), quote(title), quote(subtitle)))
 
 
 def ditto(src, dst):
@@ -81,12 +117,12 @@ def ditto(src, dst):
 
 def rsync(src, dst, flags='auE'):
     """Shortcut for rsync."""
-    call('/usr/bin/rsync', '-' + flags, src, dst)
+    return call('/usr/bin/rsync', '-' + flags, src, dst)
 
 
 def dscl(domain='.', *args):
     """Shortcut for dscl."""
-    subprocess.call(['/usr/bin/dscl', domain] + args)
+    call('/usr/bin/dscl', domain, *args)
 
 
 def exec_jar(path, user):
@@ -98,38 +134,70 @@ def exec_jar(path, user):
 
 
 def osascript(s):
+    """Run AppleScript s, through the osascript session
+    if one is in use (see machammer.applescript)."""
+    session = applescript.get_session()
+
     try:
-        return check_output('/usr/bin/osascript', '-e', s)
+        if session is None:
+            return check_output('/usr/bin/osascript', '-e', s)
+        result = session.run(s)
     except Exception as e:
         raise Exception('The AppleScript returned an error: %s' % e)
 
+    # same as from osascript itself
+    if isinstance(result, list):
+        result = ', '.join(str(x) for x in result)
+
+    return result.encode('utf-8') if result else None
+
 
 def tell_app(app, s):
-    return osascript('tell application "%s" to %s' % (app, s))
+    return osascript('tell application %s to %s' % (applescript.quote(app), s))
+
+
+def applescript_batch(app, raise_errors=True):
+    """Return a Batch of statements for app, sent as one script
+    when the with block exits:
+
+    with applescript_batch('System Events') as b:
+        name = b.get('name of current screen saver')
+        b.run('delete every login item whose name is %s', 'Dropbox')
+    print(name.value)
+    """
+    def execute(script):
+        result = osascript(script)
+        return result.decode('utf-8') if result else ''
+
+    return applescript.Batch(app, execute, raise_errors)
 
 
 def quit_app(app):
     tell_app(app, 'quit')
 
 
-def copy_app(path):
-    """Copy path to /Applications folder."""
-    rsync(path.rstrip('/'), '/Applications/')
+def copy_app(path, dest='/Applications'):
+    """Copy path to /Applications folder (or dest)."""
+    return rsync(path.rstrip('/'), os.path.join(dest, ''))
+
 
+def unzip_app(path, sha256=None, dest='/Applications'):
+    """Install zipped application into /Applications (or dest).
+    If sha256 is given, the archive must match it."""
+    if sha256:
+        verify(path, sha256)
 
-def unzip_app(path):
-    """Install zipped application."""
-    call('/usr/bin/unzip', '-q', path, '-d', '/Applications')
+    return call('/usr/bin/unzip', '-q', path, '-d', dest)
 
 
 def enable_ard(username, privs='-all'):
     """Enable Apple Remote Desktop for username."""
-    subprocess.call(['/System/Library/CoreServices/RemoteManagement/ARDAgent.app/Contents/Resources/kickstart',
-                     '-activate', '-configure',
-                     '-access', '-on',
-                     '-users', username,
-                     '-privs', privs,
-                     '-restart', '-agent'])
+    call('/System/Library/CoreServices/RemoteManagement/ARDAgent.app/Contents/Resources/kickstart',
+         '-activate', '-configure',
+         '-access', '-on',
+         '-users', username,
+         '-privs', privs,
+         '-restart', '-agent')
 
 
 def sleep():
@@ -153,27 +221,23 @@ def mount_image(path, mp=None, *args):
         raise Exception('Invalid path: %s' % path)
 
     mp = mp or tempfile.mkdtemp()
-    p = subprocess.Popen(('/usr/bin/hdiutil', 'mount',
-                         '-mountpoint', mp, 
-                         '-nobrowse', path) + args,
-                         stdout=subprocess.PIPE,
-                         stdin=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-
     # work around EULA prompt
-    out, err = p.communicate(input=b'Q\nY\n')
+    out = popen(('/usr/bin/hdiutil', 'mount',
+                 '-mountpoint', mp,
+                 '-nobrowse', path) + args, input=b'Q\nY\n')
     logging.debug('mount_image got %s' % out)
 
-    if err:
-        raise Exception(err)
-
     return mp
 
 
-def mount_and_install(dmg, pkg):
-    """Mounts the DMG and installs the PKG."""
+def mount_and_install(dmg, pkg, sha256=None):
+    """Mounts the DMG and installs the PKG.
+    If sha256 is given, the DMG must match it."""
+    if sha256:
+        verify(dmg, sha256)
+
     with mount(dmg) as p:
-        install_pkg(os.path.join(p, pkg))
+        return install_pkg(os.path.join(p, pkg))
 
 
 def install_profile(path):
@@ -181,15 +245,17 @@ def install_profile(path):
     call('/usr/bin/profiles', '-I', '-F', path)
 
 
-def install_pkg(pkg, target='/'):
-    """Install a package."""
-    call('/usr/sbin/installer', '-pkg', pkg, '-target', target)
+def install_pkg(pkg, target='/', sha256=None):
+    """Install a package.
+    If sha256 is given, the package must match it."""
+    if sha256:
+        verify(pkg, sha256)
 
+    return call('/usr/sbin/installer', '-pkg', pkg, '-target', target)
 
-@contextmanager
-def fetch(url, *args):
-    """Fetch URL with curl and return path to download.
-    All args are passed to curl as is"""
+
+def curl_args(url, args):
+    """Return (curl args, output path, is temporary) for fetching url."""
     try:
         from urlparse import urlparse
     except ImportError:
@@ -216,7 +282,27 @@ def fetch(url, *args):
 
     args.append(url.geturl())
     logging.debug('Running curl with %s' % args)
+    return args, path, tmp
+
+
+@contextmanager
+def fetch(url, *args, **kwargs):
+    """Fetch URL with curl and return path to download.
+    All args are passed to curl as is.
 
+    With cache=True or sha256='...' the download goes through the
+    download cache instead (see machammer.download): it is only
+    downloaded if needed, resumed if interrupted and checked against
+    sha256. The cached file is left in place. segments=N downloads
+    big files over N connections.
+    """
+    if kwargs.get('cache') or kwargs.get('sha256') or kwargs.get('segments'):
+        if args:
+            raise ValueError('curl arguments are not supported with cache')
+        yield get_downloader().get(url, kwargs.get('sha256'), kwargs.get('segments', 1))
+        return
+
+    args, path, tmp = curl_args(url, args)
     call('/usr/bin/curl', *args)
 
     yield path
@@ -226,6 +312,12 @@ def fetch(url, *args):
         logging.debug('Deleted tempfile %s' % path)
 
 
+def fetch_many(urls, sha256s=None, segments=1):
+    """Download urls in parallel through the download cache,
+    return list of paths."""
+    return get_downloader().get_many(urls, sha256s, segments)
+
+
 def mount_afp(url, username, password, mp=None):
     """Mount AFP share."""
     mp = mp or tempfile.mkdtemp()
@@ -266,7 +358,7 @@ def eject(path):
 def install_su(restart=True):
     """Install all available Apple software Updates,
     restart if any update requires it."""
-    su_results = subprocess.check_output(['/usr/sbin/softwareupdate', '-ia'])
+    su_results = (check_output('/usr/sbin/softwareupdate', '-ia') or b'').decode()
     if restart and ('restart' in su_results):
         # Easy way to reboot without special privileges
         tell_app('Finder', 'restart')
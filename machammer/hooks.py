@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 from . import defaults
 
 PREF_DOMAIN = 'com.apple.loginwindow'
+LAUNCH_DAEMONS = '/Library/LaunchDaemons'
+LAUNCH_AGENTS = '/Library/LaunchAgents'
 
 
 def login(path=None):
@@ -31,20 +35,26 @@ def shutdown(path=None):
     pass
 
 
+def launchd(plist, path, **keys):
+    """Write launchd job plist that runs path, remove it if path is None."""
+    if path is None:
+        if os.path.exists(defaults.domain_path(plist)):
+            os.unlink(defaults.domain_path(plist))
+        return
+
+    with defaults.transaction() as t:
+        t.domain(plist).update(Program=path, **keys)
+
+
 def mount(mountpoint, path=None):
     """Execute path if mountpoint is mounted. Set path to None to disable."""
     label = 'com.github.filipp.machammer.mounthook'
-    plist = '/Library/LaunchDaemons/' + label
-    defaults.set(plist, 'Label', label)
-    defaults.set(plist, 'Program', path)
-    defaults.set(plist, 'StartOnMount', '-boolean', 'TRUE')
-    defaults.set(plist, 'WatchPaths', '-array', mountpoint)
+    plist = os.path.join(LAUNCH_DAEMONS, label)
+    launchd(plist, path, Label=label, StartOnMount=True, WatchPaths=[mountpoint])
 
 
 def agent(path=None):
     """Execute path if mountpoint is mounted. Set path to None to disable."""
     label = 'com.github.filipp.machammer.loginhook'
-    plist = '/Library/LaunchAgents/' + label
-    defaults.set(plist, 'Label', label)
-    defaults.set(plist, 'Program', path)
-    defaults.set(plist, 'RunAtLoad', '-boolean', 'TRUE')
+    plist = os.path.join(LAUNCH_AGENTS, label)
+    launchd(plist, path, Label=label, RunAtLoad=True)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""Install only what is missing or out of date.
+
+The Planner compares what an installer would install with what is on
+the machine - package receipts for pkgs, the app's Info.plist for apps
+- and only runs the installs that are needed:
+
+    p = installer.Planner()
+    p.pkg('/tmp/Office.pkg')
+    p.app('/Volumes/Viscosity/Viscosity.app')
+    p.zip('/tmp/Slack.zip')
+    p.dmg('/tmp/Java.dmg', 'Java.pkg')
+    for step in p.run():
+        print(step)
+"""
+
+import os
+import re
+import zlib
+import struct
+import zipfile
+import plistlib
+from xml.etree import ElementTree
+
+from . import functions
+
+NOOP = 'noop'
+INSTALL = 'install'
+UPGRADE = 'upgrade'
+
+RECEIPTS_DIR = '/var/db/receipts'
+APPLICATIONS_DIR = '/Applications'
+
+
+def parse_version(v):
+    """Return a sortable key for version string v."""
+    return [(1, int(x)) if x.isdigit() else (0, x)
+            for x in re.findall(r'\d+|[A-Za-z]+', str(v or ''))]
+
+
+def xar_files(path):
+    """Return {name: bytes reader} of the top level files in the
+    xar archive (flat package) at path, and of those one level down
+    (e.g. 'Office.pkg/PackageInfo')."""
+    with open(path, 'rb') as f:
+        header = f.read(28)
+        if header[:4] != b'xar!':
+            raise ValueError('Not a flat package: %s' % path)
+
+        size, _, toc_len, _, _ = struct.unpack('>HHQQI', header[4:])
+        f.seek(size)
+        toc = ElementTree.fromstring(zlib.decompress(f.read(toc_len)))
+
+    heap = size + toc_len
+    files = {}
+
+    def read(data):
+        def reader():
+            with open(path, 'rb') as f:
+                f.seek(heap + int(data.find('offset').text))
+                raw = f.read(int(data.find('length').text))
+            encoding = data.find('encoding').get('style')
+            if encoding == 'application/x-gzip':
+                return zlib.decompress(raw)
+            if encoding == 'application/x-bzip2':
+                import bz2
+                return bz2.decompress(raw)
+            return raw
+        return reader
+
+    def walk(parent, prefix):
+        for f in parent.findall('file'):
+            name = prefix + f.find('name').text
+            if f.find('data') is not None:
+                files[name] = read(f.find('data'))
+            if not prefix:
+                walk(f, name + '/')
+
+    walk(toc.find('toc'), '')
+    return files
+
+
+def pkg_info(pkg):
+    """Return [(identifier, version)] of the components in package pkg."""
+    if os.path.isdir(pkg):
+        # old-style bundle package
+        info = functions.get_plist(os.path.join(pkg, 'Contents', 'Info.plist'))
+        return [(info['CFBundleIdentifier'], info.get('CFBundleShortVersionString'))]
+
+    files = xar_files(pkg)
+    infos = [k for k in sorted(files) if k.split('/')[-1] == 'PackageInfo']
+    result = []
+
+    for k in infos:
+        e = ElementTree.fromstring(files[k]())
+        result.append((e.get('identifier'), e.get('version')))
+
+    if not result and 'Distribution' in files:
+        for e in ElementTree.fromstring(files['Distribution']()).iter('pkg-ref'):
+            if e.get('version'):
+                result.append((e.get('id'), e.get('version')))
+
+    return result
+
+
+def bundle_info(plist):
+    return (plist.get('CFBundleIdentifier'), plist.get('CFBundleShortVersionString'))
+
+
+def app_info(app):
+    """Return (identifier, version) of the app bundle at path app."""
+    return bundle_info(functions.get_plist(os.path.join(app, 'Contents', 'Info.plist')))
+
+
+def zip_info(path):
+    """Return (app name, (identifier, version)) of the app in zip archive path."""
+    with zipfile.ZipFile(path) as z:
+        for name in z.namelist():
+            parts = name.split('/')
+            if len(parts) == 3 and parts[0].endswith('.app') and parts[1:] == ['Contents', 'Info.plist']:
+                return parts[0], bundle_info(plistlib.loads(z.read(name)))
+
+    raise ValueError('No application found in %s' % path)
+
+
+class Step(object):
+    def __init__(self, kind, path, action, identifier=None,
+                 installed=None, available=None, args=()):
+        self.kind = kind
+        self.path = path
+        self.action = action
+        self.identifier = identifier
+        self.installed = installed
+        self.available = available
+        self.args = args
+        self.result = None
+
+    def __repr__(self):
+        return '<Step %s %s %s: %s -> %s>' % (self.action, self.kind, self.identifier,
+                                              self.installed, self.available)
+
+
+class Planner(object):
+    """Collect pkgs and apps, then plan() or run() their installation.
+
+    receipts and applications can point elsewhere, e.g. for testing.
+    Apps are looked for and installed in applications.
+    """
+    def __init__(self, receipts=RECEIPTS_DIR, applications=APPLICATIONS_DIR, target='/'):
+        self.receipts = receipts
+        self.applications = applications
+        self.target = target
+        self.items = []
+
+    def pkg(self, path, sha256=None):
+        self.items.append(('pkg', path, (sha256,)))
+
+    def app(self, path):
+        self.items.append(('app', path, ()))
+
+    def zip(self, path, sha256=None):
+        self.items.append(('zip', path, (sha256,)))
+
+    def dmg(self, path, pkg, identifier=None, version=None, sha256=None):
+        """Install pkg from disk image path. If identifier and version
+        are given the image is only mounted if it needs installing."""
+        self.items.append(('dmg', path, (pkg, identifier, version, sha256)))
+
+    def installed_pkg(self, identifier):
+        """Return the installed version of package identifier."""
+        path = os.path.join(self.receipts, identifier + '.plist')
+
+        if os.path.exists(path):
+            return functions.get_plist(path).get('PackageVersion')
+
+    def installed_app(self, name):
+        path = os.path.join(self.applications, name)
+
+        if os.path.exists(os.path.join(path, 'Contents', 'Info.plist')):
+            return app_info(path)[1]
+
+    def action(self, installed, available):
+        if installed is None:
+            return INSTALL
+
+        if parse_version(available) > parse_version(installed):
+            return UPGRADE
+
+        return NOOP
+
+    def _pkg_step(self, kind, path, components, args):
+        """Step for a package, the most needed of its components wins."""
+        steps = []
+
+        for identifier, version in components:
+            installed = self.installed_pkg(identifier)
+            steps.append(Step(kind, path, self.action(installed, version),
+                              identifier, installed, version, args))
+
+        order = [INSTALL, UPGRADE, NOOP]
+        steps.sort(key=lambda s: order.index(s.action))
+        return steps[0] if steps else Step(kind, path, INSTALL, args=args)
+
+    def _step(self, kind, path, args):
+        if kind == 'pkg':
+            return self._pkg_step(kind, path, pkg_info(path), args)
+
+        if kind == 'dmg':
+            pkg, identifier, version = args[:3]
+            if identifier and version:
+                return self._pkg_step(kind, path, [(identifier, version)], args)
+            with functions.mount(path) as mp:
+                return self._pkg_step(kind, path, pkg_info(os.path.join(mp, pkg)), args)
+
+        if kind == 'app':
+            name = os.path.basename(path.rstrip('/'))
+            identifier, version = app_info(path)
+        else:
+            name, (identifier, version) = zip_info(path)
+
+        installed = self.installed_app(name)
+        return Step(kind, path, self.action(installed, version),
+                    identifier, installed, version, args)
+
+    def plan(self):
+        """Return a Step for everything added."""
+        return [self._step(*x) for x in self.items]
+
+    def run(self, steps=None):
+        """Run the steps that are not no-ops, return all steps."""
+        steps = steps or self.plan()
+
+        for s in steps:
+            if s.action == NOOP:
+                continue
+
+            if s.kind == 'pkg':
+                s.result = functions.install_pkg(s.path, self.target, sha256=s.args[0])
+            elif s.kind == 'dmg':
+                s.result = functions.mount_and_install(s.path, s.args[0], sha256=s.args[3])
+            elif s.kind == 'app':
+                s.result = functions.copy_app(s.path, self.applications)
+            elif s.kind == 'zip':
+                s.result = functions.unzip_app(s.path, sha256=s.args[0], dest=self.applications)
+
+        return steps
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Optional timing of the commands machammer runs.
+
+Off by default; when off, the only cost is one global lookup per
+command. Turn it on for a block:
+
+    with instrument.enabled() as stats:
+        install_everything()
+    print(stats.report())
+
+or for a whole run with MH_PROFILE=1, which logs the report at exit.
+"""
+
+import os
+import sys
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+stats = None
+
+
+class Command(object):
+    def __init__(self, argv, seconds, returncode, caller):
+        self.argv = argv
+        self.seconds = seconds
+        self.returncode = returncode
+        self.caller = caller
+
+    @property
+    def binary(self):
+        return os.path.basename(self.argv[0])
+
+    @property
+    def module(self):
+        return self.caller.split('.')[0]
+
+
+class Stats(object):
+    """Commands run and counters collected while instrumented."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = []
+        self.counters = {}
+        self.timings = {}
+
+    def add(self, argv, seconds, returncode):
+        self.commands.append(Command(argv, seconds, returncode, caller()))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def time(self, name, seconds):
+        with self.lock:
+            n, t = self.timings.get(name, (0, 0.0))
+            self.timings[name] = (n + 1, t + seconds)
+
+    def total(self):
+        return sum(c.seconds for c in self.commands)
+
+    def top(self, n=10):
+        """Return the n slowest commands."""
+        return sorted(self.commands, key=lambda c: c.seconds, reverse=True)[:n]
+
+    def group(self, attr):
+        """Return [(value, count, seconds)] of commands grouped by attr,
+        slowest first."""
+        groups = {}
+
+        for c in self.commands:
+            k = getattr(c, attr)
+            n, t = groups.get(k, (0, 0.0))
+            groups[k] = (n + 1, t + c.seconds)
+
+        return sorted(((k, n, t) for k, (n, t) in groups.items()),
+                      key=lambda x: x[2], reverse=True)
+
+    def report(self, n=10):
+        lines = ['%d commands, %.3f s total' % (len(self.commands), self.total())]
+
+        for title, attr in (('Per module', 'module'), ('Per binary', 'binary')):
+            lines.append('')
+            lines.append(title + ':')
+            for k, count, t in self.group(attr):
+                lines.append('  %-40s %5d %10.3f s' % (k, count, t))
+
+        lines.append('')
+        lines.append('Slowest commands:')
+        for c in self.top(n):
+            lines.append('  %8.3f s [%d] %s (%s)' % (c.seconds, c.returncode,
+                                                     ' '.join(c.argv)[:80], c.caller))
+
+        if self.timings:
+            lines.append('')
+            lines.append('Timings:')
+            for k in sorted(self.timings):
+                n, t = self.timings[k]
+                lines.append('  %-40s %5d %10.3f s' % (k, n, t))
+
+        if self.counters:
+            lines.append('')
+            lines.append('Counters:')
+            for k in sorted(self.counters):
+                lines.append('  %-40s %5d' % (k, self.counters[k]))
+
+        return '\n'.join(lines)
+
+
+def caller():
+    """Return module.function of the outermost machammer frame
+    on the stack, i.e. the API the user called."""
+    name = 'unknown'
+    f = sys._getframe(1)
+
+    while f is not None:
+        module = f.f_globals.get('__name__', '')
+        if module.startswith('machammer.'):
+            name = '%s.%s' % (module[10:], f.f_code.co_name)
+        f = f.f_back
+
+    return name
+
+
+def count(name, n=1):
+    s = stats
+
+    if s is not None:
+        s.count(name, n)
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the with block to timing name."""
+    s = stats
+
+    if s is None:
+        yield
+        return
+
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        s.time(name, time.time() - start)
+
+
+@contextmanager
+def enabled():
+    """Instrument the with block, yield the Stats."""
+    global stats
+    previous, stats = stats, Stats()
+
+    try:
+        yield stats
+    finally:
+        stats = previous
+
+
+def _log_report():
+    logging.warning('machammer profile:\n%s', stats.report())
+
+
+if os.getenv('MH_PROFILE'):
+    stats = Stats()
+    atexit.register(_log_report)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Checksums of installer files, remembered between runs.
+
+Hashing a multi-GB disk image takes a while, so digests are kept in a
+small index together with the file's size, mtime and inode. As long as
+those don't change, the file is not read again:
+
+    integrity.verify('/tmp/Office.pkg', '5f2b...')
+"""
+
+import os
+import mmap
+import hashlib
+
+from .cache import FileCache, default_root
+
+BUFSIZE = 4 * 1024 * 1024
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def hash_file(path, use_mmap=True):
+    """Return the SHA-256 hex digest of the file at path.
+
+    Maps the file into memory (or reads it in large blocks) so
+    hashlib can work through it without copying it into Python.
+    """
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if use_mmap and size > 0:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                h.update(m)
+            finally:
+                m.close()
+        else:
+            buf = bytearray(BUFSIZE)
+            view = memoryview(buf)
+            for n in iter(lambda: f.readinto(buf), 0):
+                h.update(view[:n])
+
+    return h.hexdigest()
+
+
+class Index(object):
+    """Remember digests of files by (size, mtime, inode)."""
+    def __init__(self, root=None):
+        root = root or os.path.join(default_root(), 'integrity')
+        self.cache = FileCache(root, ttl=float('inf'))
+
+    def key(self, path):
+        return hashlib.sha1(os.path.realpath(path).encode('utf-8')).hexdigest()
+
+    def stat(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, path):
+        """Return the known digest of path, if it hasn't changed."""
+        hit = self.cache.get(self.key(path))
+
+        if hit and hit[0]['stat'] == self.stat(path):
+            return hit[0]['sha256']
+
+    def record(self, path, digest):
+        """Remember that path hashes to digest, e.g. after
+        hashing it while it was downloaded."""
+        self.cache.set(self.key(path), {'path': path,
+                                        'stat': self.stat(path),
+                                        'sha256': digest})
+
+    def digest(self, path):
+        """Return digest of path, hashing it only if needed."""
+        digest = self.get(path)
+
+        if digest is None:
+            digest = hash_file(path)
+            self.record(path, digest)
+
+        return digest
+
+
+_index = None
+
+
+def get_index():
+    """Return the shared Index."""
+    global _index
+
+    if _index is None:
+        _index = Index()
+
+    return _index
+
+
+def verify(path, sha256):
+    """Raise ChecksumError unless the file at path hashes to sha256."""
+    digest = get_index().digest(path)
+
+    if digest != sha256.lower():
+        raise ChecksumError('Checksum mismatch for %s: expected %s, got %s' % (path, sha256, digest))
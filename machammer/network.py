@@ -1,11 +1,36 @@
 # -*- coding: utf-8 -*-
-"""Network-related machammer functions."""
+"""Network-related machammer functions.
 
+The status helpers (is_wired, get_primary, get_wifi_power...) read from
+a Snapshot of the network state, gathered all at once:
+
+    s = network.snapshot()
+    s.primary, s.active['en0'], s.wifi_power
+
+On Linux the snapshot is read from /sys and /proc without running
+anything, on macOS the commands it needs run in parallel.
+"""
+
+import os
 import re
+import time
+import socket
+import threading
+from types import MappingProxyType
+from collections import namedtuple
+
+from . import tasks
 from .process import kill
 from .functions import call, check_output
 from .system_profiler import SystemProfile
 
+SYS_NET = '/sys/class/net'
+PROC_ROUTE = '/proc/net/route'
+TTL = 1.0
+
+Port = namedtuple('Port', 'name interface type')
+Snapshot = namedtuple('Snapshot', 'ports active primary wifi_power computer_name taken')
+
 
 def networksetup(*args):
     return check_output('/usr/sbin/networksetup', *args)
@@ -17,8 +42,7 @@ def systemsetup(*args):
 
 def get_ports(type='Ethernet'):
     """Return all devices of type (Ethernet, AirPort)"""
-    profile = SystemProfile('Network')
-    return [x for x in profile if x['type'] == type]
+    return SystemProfile('Network').filter(type=type)
 
 
 def set_wifi_power(on=True):
@@ -26,50 +50,200 @@ def set_wifi_power(on=True):
     state = 'on' if on else 'off'
     for i in get_ports('AirPort'):
         networksetup('-setairportpower', i['interface'], state)
+    invalidate()
 
 
 def disable_wifi(port='en1'):
     networksetup('-setairportpower', port, 'off')
     networksetup('-setnetworkserviceenabled', 'Wi-Fi', 'off')
+    invalidate()
+
 
+def parse_power(out):
+    """Return power state from networksetup -getairportpower output."""
+    return out.decode().split(': ')[1].strip()
 
-def get_wifi_power():
+
+def get_wifi_power(ttl=TTL):
     """Get AirPort power state."""
-    results = []
-    for i in get_ports('AirPort'):
-        iface = i['interface']
-        r = networksetup('-getairportpower', iface)
-        results.append(r.split(': ')[1])
+    return snapshot(ttl).wifi_power
+
+
+def parse_active(out):
+    """Return True if ifconfig output says the interface is active."""
+    return b'status: active' in (out or b'')
+
+
+def parse_ifconfig(out):
+    """Return {interface: active} from the output of ifconfig (all
+    interfaces). Interfaces without a media status are active if
+    they are up and running."""
+    result = {}
+    iface = None
+
+    for line in out.decode().splitlines():
+        if line and not line[0].isspace():
+            iface, _, rest = line.partition(': ')
+            flags = rest[rest.find('<') + 1:rest.find('>')].split(',')
+            result[iface] = 'UP' in flags and 'RUNNING' in flags
+        elif iface and line.strip().startswith('status: '):
+            result[iface] = line.strip() == 'status: active'
 
-    return 'On' in results
+    return result
 
 
-def is_wired(primary=False):
-    """Do we have an "active" Ethernet connection?"""
-    for p in get_ports('Ethernet'):
-        try:
-            r = check_output('/sbin/ifconfig', p['interface'])
-        except Exception as e:
-            raise Exception('Failed to get interface status: %s' % e)
+def is_wired(primary=False, ttl=TTL):
+    """Do we have an "active" Ethernet connection?
+    With primary=True, is it the primary interface?"""
+    s = snapshot(ttl)
+    ports = [p.interface for p in s.ports if p.type == 'Ethernet']
 
-        active = 'status: active' in r
-        return get_primary(p['interface']) if primary else active
+    if primary:
+        return s.primary in ports
 
+    return any(s.active.get(p) for p in ports)
 
-def is_wireless():
-    return not is_wired()
 
+def is_wireless(ttl=TTL):
+    return not is_wired(ttl=ttl)
 
-def get_primary(port=None):
+
+def parse_route(out, port=None):
+    """Return interface (or if it is port) from route get output."""
+    for i in [x for x in out.decode().split('\n') if 'interface: ' in x]:
+        p = i.split(': ')[1].strip()
+        return p == port if port else p
+
+
+def parse_proc_route(out, port=None):
+    """Return interface (or if it is port) of the default route in /proc/net/route."""
+    for line in out.decode().splitlines()[1:]:
+        fields = line.split()
+        if len(fields) > 7 and fields[1] == '00000000' and fields[7] == '00000000':
+            return fields[0] == port if port else fields[0]
+
+
+def get_primary(port=None, ttl=TTL):
     """Return device node of primary network interface"""
+    primary = snapshot(ttl).primary
+    return primary == port if port else primary
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _sys_ports():
+    ports = []
+
+    for iface in sorted(os.listdir(SYS_NET)):
+        base = os.path.join(SYS_NET, iface)
+        if os.path.isdir(os.path.join(base, 'wireless')):
+            kind = 'AirPort'
+        elif _read(os.path.join(base, 'type')).strip() == b'1':
+            kind = 'Ethernet'
+        else:
+            kind = 'Other'
+        ports.append(Port(iface, iface, kind))
+
+    return ports
+
+
+def _sys_snapshot():
+    """Snapshot from /sys and /proc, no commands needed."""
+    ports = _sys_ports()
+    active = {}
+
+    for p in ports:
+        state = _read(os.path.join(SYS_NET, p.interface, 'operstate')).strip()
+        active[p.interface] = state == b'up'
+
     try:
-        route = check_output('/sbin/route', 'get', 'default').split('\n')
-    except Exception as e:
-        raise Exception('Failed to get default route: %s' % e)
+        primary = parse_proc_route(_read(PROC_ROUTE))
+    except (IOError, OSError):
+        primary = None
 
-    for i in [x for x in route if 'interface: ' in x]:
-        p = i.split(': ')[1]
-        return p == port if port else p
+    # administratively up, like networksetup's power state
+    wifi = any(int(_read(os.path.join(SYS_NET, p.interface, 'flags')), 16) & 1
+               for p in ports if p.type == 'AirPort')
+
+    return ports, active, primary, wifi, socket.gethostname()
+
+
+def parse_ports(items):
+    """Return Ports of the Network profile items that have an interface."""
+    return [Port(i.get('_name'), i['interface'], i.get('type'))
+            for i in items if i.get('interface')]
+
+
+def _profile_ports():
+    return parse_ports(SystemProfile('Network'))
+
+
+def _route():
+    try:
+        return parse_route(check_output('/sbin/route', '-n', 'get', 'default'))
+    except Exception:
+        # no default route
+        return None
+
+
+def _wifi(ports):
+    return any(parse_power(networksetup('-getairportpower', p.interface)) == 'On'
+               for p in ports if p.type == 'AirPort')
+
+
+def _mac_snapshot():
+    """Snapshot from system_profiler and friends, run in parallel."""
+    ex = tasks.Executor(max_workers=5)
+    ex.add('ports', _profile_ports)
+    ex.add('active', lambda: parse_ifconfig(check_output('/sbin/ifconfig') or b''))
+    ex.add('primary', _route)
+    ex.add('name', lambda: (networksetup('-getcomputername') or b'').decode())
+    ex.add('wifi', lambda: _wifi(ex.tasks['ports'].result), after=['ports'])
+    results = ex.run()
+
+    for t in results.values():
+        if t.status == tasks.FAILED:
+            raise t.error
+
+    return [results[k].result for k in ('ports', 'active', 'primary', 'wifi', 'name')]
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def recent(ttl):
+    """Return the last Snapshot if it was taken less than ttl
+    seconds ago, otherwise None."""
+    s = _snapshot
+    if ttl and s and time.time() - s.taken < ttl:
+        return s
+
+
+def remember(ports, active, primary, wifi, name):
+    """Make a Snapshot of this state the last one and return it."""
+    global _snapshot
+    _snapshot = Snapshot(tuple(ports), MappingProxyType(active), primary, wifi, name, time.time())
+    return _snapshot
+
+
+def snapshot(ttl=0):
+    """Return Snapshot of the network state, reusing one
+    taken less than ttl seconds ago."""
+    with _lock:
+        s = recent(ttl)
+        if s is None:
+            s = remember(*(_sys_snapshot() if os.path.isdir(SYS_NET) else _mac_snapshot()))
+        return s
+
+
+def invalidate():
+    """Forget the last snapshot, e.g. after changing settings."""
+    global _snapshot
+    _snapshot = None
 
 
 def flush_dns():
@@ -84,6 +258,7 @@ def get_computer_name():
 
 def set_computer_name(name, hostname=True):
     networksetup('-setcomputername', name)
+    invalidate()
     if hostname:
         set_hostname(name)
 
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Incremental parsing of system_profiler XML output.
+
+plistlib builds the whole document in memory, which for types like
+Applications or Fonts means tens of megabytes. iterparse() only keeps
+the item currently being parsed.
+"""
+
+import base64
+import datetime
+from xml.etree.ElementTree import iterparse as _iterparse
+
+
+def value(elem):
+    """Return the Python value of plist element elem."""
+    tag = elem.tag
+
+    if tag == 'dict':
+        d = {}
+        key = None
+        for child in elem:
+            if child.tag == 'key':
+                key = child.text or ''
+            else:
+                d[key] = value(child)
+        return d
+
+    if tag == 'array':
+        return [value(x) for x in elem]
+
+    if tag == 'string':
+        return elem.text or ''
+
+    if tag == 'integer':
+        return int(elem.text)
+
+    if tag == 'real':
+        return float(elem.text)
+
+    if tag == 'true':
+        return True
+
+    if tag == 'false':
+        return False
+
+    if tag == 'date':
+        return datetime.datetime.strptime(elem.text, '%Y-%m-%dT%H:%M:%SZ')
+
+    if tag == 'data':
+        return base64.b64decode(''.join((elem.text or '').split()))
+
+    raise ValueError('Unsupported plist element: %s' % tag)
+
+
+def iterparse(source):
+    """Yield (data type, item) for every entry in the _items arrays
+    of system_profiler -xml output read from file object source.
+
+    Every item is discarded from the tree once it has been yielded.
+    """
+    # depth of the elements we care about:
+    # <plist> <array> <dict> <key>/<array> <dict>
+    SECTION, FIELD, ITEM = 3, 4, 5
+    depth = 0
+    key = None
+    dt = None
+    items = None
+
+    for event, elem in _iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == FIELD and elem.tag == 'array' and key == '_items':
+                items = elem
+            continue
+
+        if depth == ITEM and items is not None:
+            yield (dt, value(elem))
+            items.remove(elem)
+        elif depth == FIELD:
+            if elem.tag == 'key':
+                key = elem.text
+            elif key == '_dataType':
+                dt = elem.text
+            if elem is items:
+                items = None
+        elif depth == SECTION:
+            elem.clear()
+            key = dt = None
+
+        depth -= 1
@@ -4,20 +4,187 @@ try:
     import CoreFoundation
     from AppKit import NSWorkspace, NSUserDefaults, NSRunningApplication
 except ImportError:
-    raise Exception('Sorry, but it looks like your Python installation lacks PyObjc support')
-
-from . import defaults
+    # Prefs falls back to reading plists, App needs PyObjC
+    CoreFoundation = None
+
+import io
+import os
+import errno
+import pwd
+import time
+import select
+import threading
+from signal import SIGKILL
+
+from . import defaults, runner, apps
 from .functions import call, tell_app
 
+PS_PATH = '/bin/ps'
+PROC_DIR = '/proc'
+TTL = 1.0
+KILL_TIMEOUT = 5
+
+
+class Proc(object):
+    """A running process. path is the executable, if known,
+    aliases other names it can be found by."""
+    def __init__(self, pid, uid, user, name, path=None, aliases=()):
+        self.pid = pid
+        self.uid = uid
+        self.user = user
+        self.name = name
+        self.path = path
+        self.aliases = aliases
+
+    @property
+    def bundle(self):
+        """Path of the app bundle the executable is in, if any."""
+        if self.path and '.app/Contents/MacOS/' in self.path:
+            return self.path[:self.path.index('.app/Contents/MacOS/') + 4]
+
+    @property
+    def bundle_id(self):
+        b = self.bundle and apps.read_bundle(self.bundle)
+        return b.identifier if b else None
+
+    def __repr__(self):
+        return '<Proc %d %s>' % (self.pid, self.name)
+
+
+class ProcessTable(object):
+    """Snapshot of running processes, looked up by pid, name
+    (executable or app name) or bundle identifier."""
+    def __init__(self, procs):
+        self.procs = list(procs)
+        self.pids = dict((p.pid, p) for p in self.procs)
+        self.names = {}
+        self._bundles = None
+
+        for p in self.procs:
+            names = set([p.name]) | set(p.aliases)
+            if p.bundle:
+                names.add(os.path.basename(p.bundle)[:-4])
+            for name in names:
+                self.names.setdefault(name, []).append(p)
+
+    def pid(self, pid):
+        return self.pids.get(pid)
+
+    def named(self, name):
+        return self.names.get(name, [])
+
+    def bundle(self, identifier):
+        if self._bundles is None:
+            bundles = {}
+            for p in self.procs:
+                if p.bundle:
+                    bundles.setdefault(p.bundle_id, []).append(p)
+            self._bundles = bundles
+
+        return self._bundles.get(identifier, [])
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.procs)
+
+    def __len__(self):
+        return len(self.procs)
+
+
+_users = {}
+
+
+def username(uid):
+    if uid not in _users:
+        try:
+            _users[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            _users[uid] = str(uid)
+
+    return _users[uid]
+
+
+def parse_ps(output):
+    """Return Procs of ps -o pid=,uid=,user=,comm= output."""
+    procs = []
+
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split(None, 3)
+        if len(fields) < 4:
+            continue
+        pid, uid, user, comm = fields
+        path = comm if comm.startswith('/') else None
+        procs.append(Proc(int(pid), int(uid), user, os.path.basename(comm), path))
+
+    return procs
+
+
+def read_ps():
+    r = runner.run([PS_PATH, '-axww', '-o', 'pid=,uid=,user=,comm='])
+    return parse_ps(r.stdout)
+
+
+def read_proc(root=PROC_DIR):
+    """Return Procs from the /proc file system at root."""
+    procs = []
+
+    for entry in os.listdir(root):
+        if not entry.isdigit():
+            continue
+
+        base = os.path.join(root, entry)
+
+        try:
+            with io.open(os.path.join(base, 'stat'), 'rb') as f:
+                stat = f.read().decode('utf-8', 'replace')
+            uid = os.stat(base).st_uid
+        except (IOError, OSError):
+            # gone already
+            continue
+
+        try:
+            path = os.readlink(os.path.join(base, 'exe'))
+        except OSError:
+            path = None
+
+        name = comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        if path and os.path.basename(path).startswith(comm):
+            # comm is cut at 15 characters
+            name = os.path.basename(path)
+
+        procs.append(Proc(int(entry), uid, username(uid), name, path, (comm,)))
+
+    return procs
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def snapshot(ttl=TTL):
+    """Return ProcessTable of the running processes, reusing one
+    taken less than ttl seconds ago."""
+    global _snapshot
+
+    with _lock:
+        if ttl and _snapshot and time.time() - _snapshot[0] < ttl:
+            return _snapshot[1]
+
+        procs = read_proc() if os.path.isdir(PROC_DIR) else read_ps()
+        _snapshot = (time.time(), ProcessTable(procs))
+        return _snapshot[1]
+
 
 def pidof(name):
-    pass
+    """Return sorted pids of processes called name."""
+    return sorted(p.pid for p in snapshot().named(name))
 
 
 def is_running(name):
-    s = 'name of every application process contains "%s"' % name
-    a = tell_app('System Events', s)
-    return a == 'true'
+    """Return True if a process called name (executable or app name) is running."""
+    return name in snapshot()
 
 
 def is_active(name):
@@ -32,47 +199,320 @@ def activate(name):
     tell_app(name, 'activate')
 
 
-def quit(name):
-    pass
+def _pids(target):
+    """Return pids of target: a pid, a process name or a list of pids."""
+    if isinstance(target, int):
+        return [target]
+
+    if isinstance(target, (list, tuple, set)):
+        return list(target)
+
+    return [p.pid for p in snapshot(0).named(target)]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _wait_kqueue(pids, deadline):
+    kq = select.kqueue()
+
+    try:
+        live = set()
+
+        for pid in pids:
+            ev = select.kevent(pid, select.KQ_FILTER_PROC,
+                               select.KQ_EV_ADD | select.KQ_EV_ONESHOT, select.KQ_NOTE_EXIT)
+            try:
+                kq.control([ev], 0, 0)
+                live.add(pid)
+            except ProcessLookupError:
+                pass
+
+        while live:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            for ev in kq.control(None, len(live), remaining):
+                live.discard(ev.ident)
+
+        return True
+    finally:
+        kq.close()
+
+
+def _wait_pidfd(pids, deadline):
+    fds = {}
+    poll = select.poll()
+
+    try:
+        for pid in pids:
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                continue
+            fds[fd] = pid
+            poll.register(fd, select.POLLIN)
+
+        while fds:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            for fd, _ in poll.poll(None if remaining is None else remaining * 1000):
+                poll.unregister(fd)
+                del fds[fd]
+                os.close(fd)
+
+        return True
+    finally:
+        for fd in fds:
+            os.close(fd)
+
 
+def _wait_poll(pids, deadline, interval=0.05):
+    live = [p for p in pids if _alive(p)]
 
-def kill(name, signal='TERM'):
+    while live:
+        if deadline is not None and time.time() >= deadline:
+            return False
+        time.sleep(interval)
+        live = [p for p in live if _alive(p)]
+
+    return True
+
+
+def wait_for_exit(target, timeout=None):
+    """Wait until the processes of target (a pid, name or list of
+    pids) have exited. Return False if timeout seconds passed first.
+
+    Uses kqueue on macOS and pidfds on Linux, so this returns as soon
+    as they are gone.
+    """
+    pids = _pids(target)
+    deadline = None if timeout is None else time.time() + timeout
+
+    if hasattr(select, 'kqueue'):
+        return _wait_kqueue(pids, deadline)
+
+    if hasattr(os, 'pidfd_open'):
+        try:
+            return _wait_pidfd(pids, deadline)
+        except OSError as e:
+            # kernel without pidfds
+            if e.errno != errno.ENOSYS:
+                raise
+
+    return _wait_poll(pids, deadline)
+
+
+def wait_for_launch(name, timeout=None, interval=0.1):
+    """Wait until a process called name is running, return its pids
+    ([] if timeout seconds passed first).
+
+    The process table is read every interval seconds at first, backing
+    off to every TTL seconds (on macOS each read runs ps)."""
+    deadline = None if timeout is None else time.time() + timeout
+
+    while True:
+        pids = [p.pid for p in snapshot(0).named(name)]
+        if pids or (deadline is not None and time.time() >= deadline):
+            return pids
+        if deadline is not None:
+            interval = min(interval, deadline - time.time())
+        time.sleep(max(interval, 0))
+        interval = min(interval * 2, TTL)
+
+
+def _escalate(pids, timeout):
+    """Wait timeout seconds for pids to exit, KILL the ones that don't."""
+    if wait_for_exit(pids, timeout):
+        return True
+
+    for pid in pids:
+        try:
+            os.kill(pid, SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    return wait_for_exit(pids, KILL_TIMEOUT)
+
+
+def quit(name, timeout=None):
+    """Ask app name to quit. With timeout, wait that long for it to
+    exit, then kill it; return True once it is gone."""
+    pids = _pids(name)
+
+    if not pids:
+        return True
+
+    tell_app(name, 'quit')
+
+    if timeout is not None:
+        return _escalate(pids, timeout)
+
+
+def kill(name, signal='TERM', timeout=None):
+    """Send signal to processes called name. With timeout, wait that
+    long for them to exit, then KILL them; return True once they are gone."""
+    pids = _pids(name) if timeout is not None else None
     call('/usr/bin/killall', '-' + signal, name)
 
+    if timeout is not None:
+        return _escalate(pids, timeout)
+
 
 def open(name):
     call('/usr/bin/open', '-a', name)
 
 
-class Prefs(object):
-
+class CFPrefsBackend(object):
+    """Preferences of domain through CFPreferences."""
     def __init__(self, domain):
         self.domain = domain
-        args = [self.domain, CoreFoundation.kCFPreferencesCurrentUser, CoreFoundation.kCFPreferencesAnyHost]
-        self.keys = CoreFoundation.CFPreferencesCopyKeyList(*args)
-        self.prefs = CoreFoundation.CFPreferencesCopyMultiple(self.keys, *args)
+        self.args = (CoreFoundation.kCFPreferencesCurrentUser, CoreFoundation.kCFPreferencesAnyHost)
 
-        if not self.prefs:
-            raise ValueError('Invalid domain: %s' % self.domain)
+    def keys(self):
+        return CoreFoundation.CFPreferencesCopyKeyList(self.domain, *self.args) or []
 
     def get(self, key):
-        if key not in self.keys:
-            raise Exception('Invalid key: %s' % key)
+        return CoreFoundation.CFPreferencesCopyValue(key, self.domain, *self.args)
+
+    def write(self, values, remove=()):
+        CoreFoundation.CFPreferencesSetMultiple(values, list(remove), self.domain, *self.args)
+
+        if not CoreFoundation.CFPreferencesSynchronize(self.domain, *self.args):
+            raise Exception('Failed to save preferences of %s' % self.domain)
+
+
+class FileBackend(object):
+    """Preferences of domain read from and written to its plist."""
+    def __init__(self, domain):
+        self.domain = domain
+        self.prefs = defaults.Domain(domain)
+
+    def keys(self):
+        # start over so Prefs.refresh() sees changes made by others
+        self.prefs = defaults.Domain(self.domain)
+        return self.prefs.keys()
 
+    def get(self, key):
         return self.prefs.get(key)
 
+    def write(self, values, remove=()):
+        self.prefs.update(values)
+        for key in remove:
+            del self.prefs[key]
+        self.prefs.save()
+
+
+class Prefs(object):
+    """Preferences of an app, as a mapping or attributes:
+
+        prefs = Prefs('com.apple.finder')
+        prefs.ShowPathbar
+        prefs['ShowPathbar'] = True
+        prefs.update(ShowPathbar=True, ShowStatusBar=True)
+
+    Nothing is read until needed, and then only the keys asked for.
+    Every write is synchronized right away, update() writes all
+    its values at once.
+    """
+    def __init__(self, domain, backend=None):
+        backend = backend or (CFPrefsBackend if CoreFoundation else FileBackend)
+        self.__dict__.update(domain=domain, backend=backend(domain), _keys=None, _values={})
+
+    @property
+    def _key_set(self):
+        if self._keys is None:
+            self.__dict__['_keys'] = set(self.backend.keys())
+        return self._keys
+
+    def keys(self):
+        return sorted(self._key_set)
+
+    def refresh(self):
+        """Forget what has been read so far."""
+        self.__dict__.update(_keys=None, _values={})
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+
+        if key not in self._values:
+            self._values[key] = self.backend.get(key)
+
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+
+        self.backend.write({}, [key])
+        self._key_set.discard(key)
+        self._values.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def __iter__(self):
+        return iter(sorted(self._key_set))
+
+    def __len__(self):
+        return len(self._key_set)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError('%s has no preference %s' % (self.domain, name))
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__ or name.startswith('_'):
+            raise AttributeError('Can\'t set %s' % name)
+
+        self[name] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     def set(self, key, value):
-        CoreFoundation.CFPreferencesSetAppValue(key, value, self.domain)
+        self[key] = value
+
+    def update(self, *args, **kwargs):
+        """Write all values with one write and synchronize."""
+        values = dict(*args, **kwargs)
+        self.backend.write(values)
+        self._key_set.update(values)
+        self._values.update(values)
 
 
 class App(object):
 
-    ws = NSWorkspace.sharedWorkspace()
-    
     def __init__(self, domain=None, name=None):
+        if CoreFoundation is None:
+            raise Exception('Sorry, but it looks like your Python installation lacks PyObjc support')
+
         if not (domain or name):
             raise Exception('Name or domain must be provided')
 
+        self.ws = NSWorkspace.sharedWorkspace()
+
         self.domain = domain
         self.prefs = Prefs(self.domain)
         self.apps = NSRunningApplication.runningApplicationsWithBundleIdentifier_(self.domain)
@@ -84,8 +524,7 @@ class App(object):
         self.name = name
 
     def is_running(self):
-        running = self.ws.runningApplications()
-        return self.domain in [a.bundleIdentifier() for a in running]
+        return bool(snapshot().bundle(self.domain))
 
     def tell(self):
         raise NotImplementedError('Scripting support not implemented')
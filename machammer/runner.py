@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""The one place where machammer runs external commands.
+
+Everything goes through the current runner, which can be swapped for
+one that records what was run or one that replays recorded results:
+
+    with runner.use(runner.ReplayRunner('fixtures/commands.json')):
+        network.get_computer_name()
+
+Setting MH_RECORD=path records every command of a run to path,
+MH_REPLAY=path serves them back from there.
+"""
+
+import io
+import os
+import json
+import time
+import atexit
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from . import instrument
+
+
+class Result(object):
+    """The outcome of running argv. stdout and stderr are None
+    if they were not captured."""
+    def __init__(self, argv, returncode, stdout=None, stderr=None):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self):
+        return '<Result %s: %d>' % (' '.join(self.argv), self.returncode)
+
+
+class Runner(object):
+    def run(self, argv, input=None, capture=True):
+        """Run argv, feeding it input, and return a Result.
+        With capture=False output goes to our stdout/stderr."""
+        raise NotImplementedError()
+
+    @contextmanager
+    def stream(self, argv):
+        """Run argv and yield its stdout as a binary file object."""
+        result = self.run(argv)
+        yield io.BytesIO(result.stdout or b'')
+
+
+class SubprocessRunner(Runner):
+    """Actually run commands."""
+    def run(self, argv, input=None, capture=True):
+        pipe = subprocess.PIPE if capture else None
+        proc = subprocess.Popen(argv,
+                                stdin=None if input is None else subprocess.PIPE,
+                                stdout=pipe,
+                                stderr=pipe)
+        out, err = proc.communicate(input)
+        return Result(argv, proc.returncode, out, err)
+
+    @contextmanager
+    def stream(self, argv):
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+
+def _encode(b):
+    return None if b is None else b.decode('utf-8', 'surrogateescape')
+
+
+def _decode(s):
+    return None if s is None else s.encode('utf-8', 'surrogateescape')
+
+
+class RecordingRunner(Runner):
+    """Run commands with runner and remember argv, input and results."""
+    def __init__(self, runner=None):
+        self.runner = runner or SubprocessRunner()
+        self.records = []
+
+    def run(self, argv, input=None, capture=True):
+        result = self.runner.run(argv, input, capture)
+        self.records.append({'argv': list(argv),
+                             'input': _encode(input),
+                             'returncode': result.returncode,
+                             'stdout': _encode(result.stdout),
+                             'stderr': _encode(result.stderr)})
+        return result
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=2)
+
+
+class ReplayRunner(Runner):
+    """Serve recorded results instead of running anything.
+
+    Records are matched on argv and input. If the same command was
+    recorded several times, the results are served in order and the
+    last one is repeated after that.
+    """
+    def __init__(self, records=()):
+        self.lock = threading.Lock()
+        self.results = {}
+
+        if isinstance(records, str):
+            with open(records) as f:
+                records = json.load(f)
+
+        for r in records:
+            self.add(r['argv'], r.get('stdout'), r.get('returncode', 0),
+                     r.get('stderr'), r.get('input'))
+
+    def add(self, argv, stdout=None, returncode=0, stderr=None, input=None):
+        """Add a result for argv. stdout and stderr are text."""
+        key = (tuple(str(x) for x in argv), input)
+        result = Result(list(key[0]), returncode, _decode(stdout or ''), _decode(stderr or ''))
+        self.results.setdefault(key, []).append(result)
+
+    def run(self, argv, input=None, capture=True):
+        key = (tuple(argv), _encode(input))
+
+        with self.lock:
+            results = self.results.get(key)
+
+            if not results:
+                raise Exception('No recorded result for: %s' % ' '.join(argv))
+
+            return results.pop(0) if len(results) > 1 else results[0]
+
+
+def _default():
+    if os.getenv('MH_REPLAY'):
+        return ReplayRunner(os.getenv('MH_REPLAY'))
+
+    if os.getenv('MH_RECORD'):
+        r = RecordingRunner()
+        atexit.register(r.save, os.getenv('MH_RECORD'))
+        return r
+
+    return SubprocessRunner()
+
+
+_runner = _default()
+
+
+def get_runner():
+    return _runner
+
+
+def set_runner(runner):
+    """Make runner the one used by all of machammer,
+    return the previous one."""
+    global _runner
+    previous, _runner = _runner, runner
+    return previous
+
+
+@contextmanager
+def use(runner):
+    """Use runner for the duration of the with block."""
+    previous = set_runner(runner)
+
+    try:
+        yield runner
+    finally:
+        set_runner(previous)
+
+
+def run(argv, input=None, capture=True):
+    """Run argv (stringified) with the current runner."""
+    argv = [str(x) for x in argv]
+    stats = instrument.stats
+
+    if stats is None:
+        return _runner.run(argv, input, capture)
+
+    start = time.time()
+    result = None
+
+    try:
+        result = _runner.run(argv, input, capture)
+        return result
+    finally:
+        returncode = -1 if result is None else result.returncode
+        stats.add(argv, time.time() - start, returncode)
+
+
+@contextmanager
+def stream(argv):
+    argv = [str(x) for x in argv]
+    stats = instrument.stats
+
+    if stats is None:
+        with _runner.stream(argv) as f:
+            yield f
+        return
+
+    start = time.time()
+
+    try:
+        with _runner.stream(argv) as f:
+            yield f
+    finally:
+        stats.add(argv, time.time() - start, 0)
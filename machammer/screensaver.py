@@ -1,4 +1,5 @@
 from .functions import tell_app
+from .applescript import quote
 
 
 def get():
@@ -6,7 +7,7 @@ def get():
 
 
 def set(name):
-    s = 'set current screen saver to (get screen saver named "%s")' % name
+    s = 'set current screen saver to (get screen saver named %s)' % quote(name)
     return tell_app('System Events', s)
 
 
@@ -1,89 +1,425 @@
 # -*- coding: utf-8 -*-
 
 import json
-import shelve
+import time
+import bisect
 import logging
-import os.path
-import tempfile
-import datetime
 import plistlib
+import threading
 import subprocess
 
-from datetime import datetime, timedelta
+from datetime import timedelta
+
+from . import runner, instrument
+from .cache import FileCache
+from .plist import iterparse
 
 
 DEFAULT_DT = 'Hardware'
 CACHE_EXPIRE = timedelta(seconds=60*60*1)
+# Per-type cache lifetimes, types not listed here use CACHE_EXPIRE
+CACHE_TTL = {
+    'Hardware': timedelta(days=7),
+    'Memory': timedelta(days=1),
+    'Network': timedelta(seconds=30),
+    'Power': timedelta(seconds=30),
+    'USB': timedelta(minutes=1),
+}
+# Serve expired entries this much past their TTL while refreshing them
+# in the background. Disabled by default.
+CACHE_STALE = timedelta(0)
 PROFILER_PATH = '/usr/sbin/system_profiler'
 
+cache = FileCache(ttl=CACHE_EXPIRE.total_seconds(),
+                  ttls=dict((k, v.total_seconds(),) for k, v in CACHE_TTL.items()),
+                  stale=CACHE_STALE.total_seconds())
 
-class SystemProfile(object):
-    def __init__(self, dt=DEFAULT_DT):
-        types = subprocess.check_output([PROFILER_PATH, '-listDataTypes']).strip()
-        types = types.decode().split("\n")
 
-        self.types = [x[2:].replace('DataType', '') for x in types if x.startswith('SP')]
-        self.types.sort()
+_types = None
+_profiles = {}
+_indexes = {}
 
-        if dt not in self.types:
-            raise ValueError('Invalid type %s. Should be one of %s' % (dt, ', '.join(self.types)))
 
-        tmp = tempfile.mkstemp()
-        self.dt = 'SP%sDataType' % dt
+def _profiler(*args):
+    r = runner.run((PROFILER_PATH,) + args)
+
+    if r.returncode != 0:
+        raise subprocess.CalledProcessError(r.returncode, r.argv, r.stdout)
+
+    return r.stdout
+
+
+def list_types():
+    """Return sorted list of available data types.
+
+    The result is cached for the life of the process.
+    """
+    global _types
+
+    if _types is None:
+        out = _profiler('-listDataTypes').strip()
+        out = out.decode().split("\n")
+        _types = sorted(x[2:].replace('DataType', '') for x in out if x.startswith('SP'))
+
+    return _types
+
+
+def check_type(dt):
+    types = list_types()
+    if dt not in types:
+        raise ValueError('Invalid type %s. Should be one of %s' % (dt, ', '.join(types)))
+
+
+def _cache_get(dt):
+    """Return (items, fresh) for data type dt or None."""
+    if dt in _profiles:
+        expires, data = _profiles[dt]
+        if expires > time.time():
+            instrument.count('system_profiler.memory_hit')
+            return (data, True)
+
+    hit = cache.get(dt, stale=True)
+
+    if hit is None:
+        instrument.count('system_profiler.miss')
+    elif hit[1]:
+        instrument.count('system_profiler.disk_hit')
+        _profiles[dt] = (time.time() + cache.get_ttl(dt), hit[0])
+    else:
+        instrument.count('system_profiler.stale_hit')
+
+    return hit
+
+
+def _cache_set(dt, data):
+    _indexes.pop(dt, None)
+    _profiles[dt] = (time.time() + cache.get_ttl(dt), data)
+    cache.set(dt, data)
+
+
+def cached(dt):
+    """Return the cached items of data type dt, None if they need
+    to be fetched."""
+    hit = _cache_get(dt)
+    return hit[0] if hit and hit[1] else None
+
+
+def store(dt, items):
+    """Cache items fetched for data type dt."""
+    _cache_set(dt, items)
+
+
+def invalidate(*types):
+    """Drop types (or everything) from the cache."""
+    for dt in types or list_types():
+        _indexes.pop(dt, None)
+        _profiles.pop(dt, None)
+        cache.delete(dt)
+
+
+def profiler_args(types):
+    """Return the system_profiler arguments that fetch types."""
+    return ['SP%sDataType' % x for x in types] + ['-detaillevel', 'full', '-xml']
+
+
+def parse_xml(xml, types):
+    """Return {type: items} from the output of system_profiler -xml."""
+    results = dict((dt, [],) for dt in types)
+
+    for item in plistlib.loads(xml):
+        dt = item.get('_dataType', '')[2:].replace('DataType', '')
+        results[dt] = item.get('_items', [])
+
+    logging.debug(results)
+    return results
+
+
+def _fetch(types):
+    """Run system_profiler once for all types and return {type: items}."""
+    try:
+        xml = _profiler(*profiler_args(types))
+    except Exception as e:
+        raise Exception('Failed to fetch system profile: %s' % e)
+
+    return parse_xml(xml, types)
+
+
+def _refresh(types):
+    """Fetch types and update the cache, return {type: items}."""
+    results = {}
+
+    with cache.lock(*types):
+        # someone else may have refreshed these while we were waiting
+        missing = []
+        for dt in types:
+            hit = cache.get(dt)
+            if hit is None:
+                missing.append(dt)
+            else:
+                results[dt] = hit[0]
+                _profiles[dt] = (time.time() + cache.get_ttl(dt), hit[0])
+
+        if missing:
+            for dt, data in _fetch(missing).items():
+                _cache_set(dt, data)
+                results[dt] = data
+
+    return results
+
+
+def load(types):
+    """Return {type: items} for types, running system_profiler
+    at most once for all the types that are not cached yet."""
+    with instrument.timed('system_profiler.load'):
+        return _load(types)
+
+
+def _load(types):
+    results = {}
+    missing = []
+    stale = []
+
+    for dt in types:
+        check_type(dt)
+        hit = _cache_get(dt)
+
+        if hit is None:
+            missing.append(dt)
+            continue
+
+        results[dt] = hit[0]
+
+        if not hit[1]:
+            stale.append(dt)
+
+    if missing:
+        results.update(_refresh(missing))
 
-        shelf_path = os.path.join(tempfile.gettempdir(), '%s.system_profiler' % self.dt)
-        shelf = shelve.open(shelf_path)
+    if stale:
+        t = threading.Thread(target=_refresh, args=(stale,))
+        t.daemon = True
+        t.start()
 
-        if shelf.get(dt) and shelf.get('expires'):
-            if shelf.get('expires') > datetime.now():
-                self._data = shelf[dt]
-                return
+    return results
 
+
+class Index(object):
+    """Lookup tables over the items of a profile, built per key
+    on first use.
+
+    exact() hashes values (and the elements of list values),
+    startswith() bisects a sorted list of string values and
+    contains() intersects trigram postings before checking the
+    candidates.
+    """
+    GRAM = 3
+
+    def __init__(self, items):
+        self.items = items
+        self._exact = {}
+        self._sorted = {}
+        self._grams = {}
+
+    def _values(self, k):
+        for i, x in enumerate(self.items):
+            if k in x:
+                yield i, x[k]
+
+    def _exact_table(self, k):
+        if k not in self._exact:
+            table = {}
+            for i, v in self._values(k):
+                for j in (v if isinstance(v, list) else [v]):
+                    try:
+                        table.setdefault(j, []).append(i)
+                    except TypeError:
+                        pass  # unhashable
+            self._exact[k] = table
+
+        return self._exact[k]
+
+    def _sorted_table(self, k):
+        if k not in self._sorted:
+            self._sorted[k] = sorted((v, i) for i, v in self._values(k)
+                                     if isinstance(v, str))
+
+        return self._sorted[k]
+
+    def _gram_table(self, k):
+        if k not in self._grams:
+            table = {}
+            for i, v in self._values(k):
+                if isinstance(v, str):
+                    for g in self.grams(v):
+                        table.setdefault(g, set()).add(i)
+            self._grams[k] = table
+
+        return self._grams[k]
+
+    def grams(self, s):
+        return set(s[i:i + self.GRAM] for i in range(len(s) - self.GRAM + 1))
+
+    def exact(self, k, v):
+        """Return positions of items whose k equals (or lists) v."""
         try:
-            subprocess.call([PROFILER_PATH, self.dt, '-detaillevel', 'full', '-xml'], stdout=tmp[0])
-        except Exception as e:
-            raise Exception('Failed to fetch system profile: %s' % e)
-        
-        xml = plistlib.readPlist(tmp[1])
-        self._data = xml[0]['_items']
-        logging.debug(self._data)
+            return list(self._exact_table(k).get(v, ()))
+        except TypeError:
+            return [i for i, x in self._values(k) if x == v]
+
+    def startswith(self, k, v):
+        """Return positions of items whose k starts with v."""
+        table = self._sorted_table(k)
+        start = bisect.bisect_left(table, (v,))
+        result = []
+
+        for value, i in table[start:]:
+            if not value.startswith(v):
+                break
+            result.append(i)
+
+        return sorted(result)
+
+    def contains(self, k, v):
+        """Return positions of items for which v in item[k]."""
+        if not isinstance(v, str) or len(v) < self.GRAM:
+            return [i for i, x in self._values(k) if v in x]
+
+        table = self._gram_table(k)
+        candidates = None
+
+        for g in self.grams(v):
+            found = table.get(g, set())
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                break
+
+        result = set(i for i in candidates if v in self.items[i][k])
+        # list values match on membership
+        result.update(i for i in self.exact(k, v) if isinstance(self.items[i][k], list))
+        return sorted(result)
+
+
+def get_index(dt, items):
+    """Return the shared Index of items for data type dt."""
+    index = _indexes.get(dt)
+
+    if index is None or index.items is not items:
+        index = _indexes[dt] = Index(items)
+
+    return index
 
-        shelf['expires'] = datetime.now() + CACHE_EXPIRE
-        shelf[dt] = self._data
-        shelf.close()
+
+def stream(dt):
+    """Yield the items of data type dt one at a time, straight from
+    system_profiler, without loading the whole profile into memory."""
+    check_type(dt)
+    args = [PROFILER_PATH, 'SP%sDataType' % dt, '-detaillevel', 'full', '-xml']
+    with runner.stream(args) as f:
+        for _, item in iterparse(f):
+            yield item
+
+
+class SystemProfile(object):
+    def __init__(self, dt=DEFAULT_DT, data=None, stream=False):
+        """Profile of data type dt. With stream=True, items are read
+        from system_profiler while iterating instead of being loaded
+        up front (unless they are already cached)."""
+        self.types = list_types()
+
+        if data is None:
+            if stream:
+                check_type(dt)
+                hit = _cache_get(dt)
+                data = hit[0] if hit else None
+            else:
+                data = load([dt])[dt]
+
+        self.name = dt
+        self.dt = 'SP%sDataType' % dt
+        self._data = data
+
+    @classmethod
+    def load_many(cls, types):
+        """Return {type: SystemProfile} for all types with one profiler run.
+
+        > SystemProfile.load_many(['Hardware', 'Network', 'Storage'])
+        """
+        return dict((dt, cls(dt, data),) for dt, data in load(types).items())
 
     def json(self):
-        return json.dumps(self._data)
+        return json.dumps(list(self))
+
+    def first(self):
+        for x in self:
+            return x
+
+        raise ValueError('Profile %s is empty' % self.name)
 
     def get_keys(self):
-        keys = self._data[0].keys()
-        keys.sort()
-        return keys
+        return sorted(self.first().keys())
 
     def get_types(self):
         return self.types
 
-    def find(self, k, v):
+    def find(self, k, v, match='contains'):
         """
-        Return value(s) of property with key k containing v
+        Return value(s) of property with key k containing v.
+        match can also be 'exact' or 'startswith'.
         """
-        return [x for x in self._data if v in x[k]]
+        if self._data is None:
+            if match == 'exact':
+                return [x for x in self if x.get(k) == v]
+            if match == 'startswith':
+                return [x for x in self if str(x.get(k, '')).startswith(v)]
+            return [x for x in self if v in x[k]]
+
+        index = get_index(self.name, self._data)
+        return [self._data[i] for i in getattr(index, match)(k, v)]
+
+    def filter(self, **kwargs):
+        """Return items matching all key=value pairs exactly.
+
+        > SystemProfile('Network').filter(type='Ethernet')
+        """
+        if self._data is None:
+            return [x for x in self if all(x.get(k) == v for k, v in kwargs.items())]
+
+        index = get_index(self.name, self._data)
+        result = None
+
+        for k, v in kwargs.items():
+            found = set(index.exact(k, v))
+            result = found if result is None else result & found
+
+        return [self._data[i] for i in sorted(result or ())]
+
+    def __iter__(self):
+        if self._data is None:
+            return stream(self.name)
+
+        return iter(self._data)
 
     def __str__(self):
-        return str(self._data)
+        return str(list(self))
 
     def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
         try:
-            return self._data[0][attr]
+            return self.first()[attr]
         except KeyError as e:
             raise ValueError('Property "%s" not found' % attr)
         
     def __getitem__(self, attr):
+        if self._data is None:
+            self._data = list(self)
+
         return self._data[attr]
 
 
 def types():
-    return SystemProfile().get_types()
+    return list_types()
 
 def keys(dt=DEFAULT_DT):
     return SystemProfile(dt).get_keys()
@@ -91,5 +427,5 @@ def keys(dt=DEFAULT_DT):
 def get(dt, param):
     return getattr(SystemProfile(dt), param)
 
-def find(dt, k, v):
-    return SystemProfile(dt).find(k, v)
+def find(dt, k, v, match='contains'):
+    return SystemProfile(dt).find(k, v, match)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Run independent machammer tasks in parallel.
+
+    ex = tasks.Executor(max_workers=4)
+    ex.add('office', functions.install_pkg, '/tmp/Office.pkg')
+    ex.add('viscosity', functions.copy_app, '/Volumes/Viscosity/Viscosity.app')
+    ex.add('printer', printers.add_printer, myprinter)
+    ex.add('dock', defaults.set, 'com.apple.dock', 'autohide', '-bool', 'true',
+           after=['office'])
+    results = ex.run()
+
+A task runs once everything in its after list has succeeded. If a
+task raises, or returns a non-zero exit status (an int, like call(),
+install_pkg() and friends do), it has failed and the tasks that
+depend on it are skipped. Pass check=None to accept any result, or a
+function of the result that returns False on failure.
+"""
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def exit_status(result):
+    """Default success check: ints are exit statuses, 0 is success."""
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result == 0
+
+    return True
+
+
+class Task(object):
+    def __init__(self, name, func, args=(), kwargs=None, after=(), check=exit_status):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.after = list(after)
+        self.check = check
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.seconds = None
+
+    def __call__(self):
+        start = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        finally:
+            self.seconds = time.time() - start
+
+        if self.check and not self.check(self.result):
+            raise Exception('Task %s failed with %r' % (self.name, self.result))
+
+        return self.result
+
+    def __repr__(self):
+        return '<Task %s: %s>' % (self.name, self.status)
+
+
+class Executor(object):
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.order = []
+
+    def add(self, name, func, *args, **kwargs):
+        """Add task name that calls func(*args, **kwargs) once the
+        tasks listed in after (a keyword argument) have succeeded.
+        check (also a keyword argument) decides if the result is a
+        success, see exit_status()."""
+        if name in self.tasks:
+            raise ValueError('Duplicate task: %s' % name)
+
+        after = kwargs.pop('after', ())
+        check = kwargs.pop('check', exit_status)
+        self.tasks[name] = Task(name, func, args, kwargs, after, check)
+        self.order.append(name)
+        return self.tasks[name]
+
+    def check(self):
+        """Raise ValueError on unknown dependencies or cycles."""
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == DONE:
+                return
+            if state.get(name) == PENDING:
+                raise ValueError('Dependency cycle: %s' % ' -> '.join(path + [name]))
+            state[name] = PENDING
+            for dep in self.tasks[name].after:
+                if dep not in self.tasks:
+                    raise ValueError('Task %s depends on unknown task %s' % (name, dep))
+                visit(dep, path + [name])
+            state[name] = DONE
+
+        for name in self.order:
+            visit(name, [])
+
+    def _schedule(self, pending, pool, running):
+        """Submit or skip pending tasks whose dependencies are settled."""
+        changed = True
+
+        while changed:
+            changed = False
+            for name in list(pending):
+                task = self.tasks[name]
+                deps = [self.tasks[d] for d in task.after]
+                failed = [d.name for d in deps if d.status in (FAILED, SKIPPED)]
+
+                if failed:
+                    task.status = SKIPPED
+                    task.error = Exception('Dependency failed: %s' % ', '.join(failed))
+                    logging.debug('Skipping task %s' % name)
+                elif all(d.status == DONE for d in deps):
+                    running[pool.submit(task)] = task
+                else:
+                    continue
+
+                pending.remove(name)
+                changed = True
+
+    def run(self):
+        """Run all tasks, return {name: Task}."""
+        self.check()
+        pending = list(self.order)
+        running = {}
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            self._schedule(pending, pool, running)
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        task.result = future.result()
+                        task.status = DONE
+                    except Exception as e:
+                        task.error = e
+                        task.status = FAILED
+                        logging.debug('Task %s failed: %s' % (task.name, e))
+
+                self._schedule(pending, pool, running)
+
+        return self.tasks
+
+    def errors(self):
+        """Return {name: exception} of failed and skipped tasks."""
+        return dict((t.name, t.error,) for t in self.tasks.values() if t.error)
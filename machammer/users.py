@@ -3,40 +3,195 @@
 
 import re
 import os
+import bisect
 import logging
 import plistlib
-import subprocess
 
-from .functions import tell_app, check_output, call
+from . import runner, applescript
+from .functions import tell_app, check_output, call, applescript_batch
+
+DSCL_PATH = '/usr/bin/dscl'
+USER_TEMPLATE = '/System/Library/User Template/'
 
 
 def dscl(*args):
     """Shortcut for accessing the local DS."""
-    return check_output('/usr/bin/dscl', '.', *args)
+    return check_output(DSCL_PATH, '.', *args)
+
+
+def _quote(arg):
+    """Escape arg for an interactive dscl command line."""
+    arg = str(arg)
+    return re.sub(r'([\s"\'\\])', r'\\\1', arg) if arg else '""'
+
+
+class DsclSession(object):
+    """Run a batch of dscl commands through one interactive dscl.
+
+    Commands are queued and piped to dscl in one go when the session
+    is flushed, or when the with block exits without an error:
+
+    > with DsclSession() as ds:
+    >     ds('create', '/Users/test')
+    >     ds('passwd', '/Users/test', 'secret')
+    """
+    def __init__(self, node='.'):
+        self.node = node
+        self.commands = []
+
+    def __call__(self, *args):
+        self.commands.append(' '.join(_quote(x) for x in args))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def flush(self):
+        """Run the queued commands, raise if dscl reported errors."""
+        if not self.commands:
+            return
+
+        script = '\n'.join(self.commands + ['quit', ''])
+        self.commands = []
+        r = runner.run([DSCL_PATH, '-q', self.node], input=script.encode('utf-8'))
+        out = (r.stdout or b'') + (r.stderr or b'')
+        errors = [x for x in out.decode('utf-8', 'replace').splitlines()
+                  if 'DS Error' in x or 'Invalid' in x]
+
+        if r.returncode != 0 or errors:
+            raise Exception('dscl failed: %s' % ('; '.join(errors) or r.returncode))
 
 
 def get_info(username):
     """Return info about a user"""
     path = '/Users/' + username
-    s = check_output('/usr/bin/dscl', '-plist', '.', 'read', path)
-    return plistlib.readPlistFromString(s)
+    s = check_output(DSCL_PATH, '-plist', '.', 'read', path)
+    return plistlib.loads(s)
+
+
+def parse_ids(s):
+    """Return the IDs in dscl -list output."""
+    ids = []
+
+    for line in (s or b'').decode().splitlines():
+        # records without the attribute only list their name
+        ids += [int(x) for x in line.split()[1:]]
+
+    return ids
+
+
+def get_ids(node='/Users', attr='UniqueID'):
+    """Return all IDs in use for DS node/attribute."""
+    return parse_ids(dscl('-list', node, attr))
+
+
+class IdAllocator(object):
+    """Hand out unused IDs for DS node/attribute.
+
+    The used IDs are listed once and kept sorted, IDs handed out or
+    added later are inserted as they go. By default the next ID is one
+    above the highest one in use (and at least start). With
+    fill_gaps=True the lowest free ID from start upwards is used
+    instead, so start is required (system accounts use IDs below 500,
+    some of them negative). reserved is a list of (first, last) ranges
+    never handed out.
+
+    > ids = IdAllocator(start=501, fill_gaps=True, reserved=[(600, 699)])
+    > ids.next()
+    """
+    def __init__(self, node='/Users', attr='UniqueID', start=None,
+                 fill_gaps=False, reserved=()):
+        if fill_gaps and start is None:
+            raise ValueError('fill_gaps needs a start ID')
+
+        self.node = node
+        self.attr = attr
+        self.start = start
+        self.fill_gaps = fill_gaps
+        self.reserved = sorted(reserved)
+        self.used = None
+        self._pending = []
+        self._cursor = None
+
+    def refresh(self, ids=None):
+        """Take a new snapshot of the used IDs, or use ids if given."""
+        if ids is None:
+            ids = get_ids(self.node, self.attr)
+        self.used = sorted(set(list(ids) + self._pending))
+        self._pending = []
+        self._cursor = None
+
+    def add(self, *ids):
+        """Mark ids as used, e.g. after creating records with them."""
+        if self.used is None:
+            self._pending += [int(i) for i in ids]
+            return
+
+        for i in ids:
+            i = int(i)
+            pos = bisect.bisect_left(self.used, i)
+            if pos == len(self.used) or self.used[pos] != i:
+                self.used.insert(pos, i)
+
+    def __contains__(self, i):
+        if self.used is None:
+            self.refresh()
+
+        pos = bisect.bisect_left(self.used, i)
+        return pos < len(self.used) and self.used[pos] == i
+
+    def _skip_reserved(self, i):
+        for first, last in self.reserved:
+            if first <= i <= last:
+                i = last + 1
+        return i
+
+    def next(self):
+        """Return the next free ID and mark it as used."""
+        if self.used is None:
+            self.refresh()
+
+        if self.fill_gaps:
+            i = self.start if self._cursor is None else self._cursor
+            pos = bisect.bisect_left(self.used, i)
+            while True:
+                i = self._skip_reserved(i)
+                pos = bisect.bisect_left(self.used, i, pos)
+                if pos == len(self.used) or self.used[pos] != i:
+                    break
+                i += 1
+        else:
+            i = self.used[-1] + 1 if self.used else 0
+            if self.start is not None:
+                i = max(i, self.start)
+            i = self._skip_reserved(i)
+
+        self.add(i)
+        self._cursor = i + 1
+        return i
 
 
 def nextid(node='/Users', attr='UniqueID'):
     """Return next available ID for DS node/attribute."""
-    s = dscl('-list', node, attr)
-    ids = re.split(r'\s+', s)[1::2]
-    return max([int(x) for x in ids]) + 1
+    return IdAllocator(node, attr).next()
 
 
 def add_login_item(path, name=None, hidden=True):
     """Add login item to the current user."""
-    if not name:
-        name = os.path.basename(path)
+    add_login_items([path], [name], hidden)
+
+
+def add_login_items(paths, names=None, hidden=True):
+    """Add login items for paths to the current user in one go."""
+    names = names or [None] * len(paths)
 
-    hidden = 'true' if hidden else 'false'
-    cmd = 'make login item at end with properties {path:"%s", hidden:%s, name:"%s"}'
-    tell_app('System Events', cmd % (path, hidden, name))
+    with applescript_batch('System Events') as b:
+        for path, name in zip(paths, names):
+            b.run('make login item at end with properties %s',
+                  {'path': path, 'hidden': hidden, 'name': name or os.path.basename(path)})
 
 
 def remove_login_item(**kwargs):
@@ -47,39 +202,63 @@ def remove_login_item(**kwargs):
     if kwargs.get('name') and kwargs.get('path'):
         raise ValueError('Please specify only path OR name')
 
-    k, v = kwargs.items()[0]
-    tell_app('System Events', 'delete every login item whose %s is "%s"' % (k, v))
+    k, v = list(kwargs.items())[0]
+    tell_app('System Events', 'delete every login item whose %s is %s' % (k, applescript.quote(v)))
 
 
 def create_user(realname, password, username=None, uid=None, gid=20):
     """Create a user account."""
+    username = create_users([{'realname': realname, 'password': password,
+                              'username': username, 'uid': uid, 'gid': gid}])[0]
+    return get_info(username)
+
+
+def create_users(accounts, uids=None, gids=None):
+    """Create many user accounts with one dscl process.
+
+    accounts is a list of dicts with the arguments of create_user.
+    New IDs come from the IdAllocators uids and gids, by default
+    ones that list the used IDs once.
+    Returns the list of created usernames.
+    """
     assert os.getuid() == 0, "Only root can create users"
-    
-    if uid is None:
-        uid = nextid()
 
-    if gid is None:
-        gid = nextid('/Groups', 'PrimaryGroupID')
+    uids = uids or IdAllocator()
+    gids = gids or IdAllocator('/Groups', 'PrimaryGroupID')
+    usernames = []
 
-    if username is None:
-        username = realname.lower().replace(' ', '.')
+    with DsclSession() as ds:
+        for a in accounts:
+            realname = a['realname']
+            username = a.get('username') or realname.lower().replace(' ', '.')
+            uid = a.get('uid')
+            gid = a.get('gid', 20)
 
-    path = '/Users/' + username
-    dscl('create', path)
-    dscl('create', path, 'RealName', realname)
-    dscl('create', path, 'UniqueID', uid)
-    dscl('create', path, 'PrimaryGroupID', gid)
-    dscl('create', path, 'UserShell', '/bin/bash')
-    dscl('create', path, 'NFSHomeDirectory', path)
+            if uid is None:
+                uid = uids.next()
+            else:
+                uids.add(uid)
 
-    dscl('passwd', path, password)
+            if gid is None:
+                gid = gids.next()
 
-    template = '/System/Library/User Template/'
-    call('/usr/bin/ditto', template + 'English.lproj/', path)
-    call('/usr/bin/ditto', template + 'Non_localized/', path)
-    call('/usr/sbin/chown', '-R', username + ':staff', path)
+            path = '/Users/' + username
+            ds('create', path)
+            ds('create', path, 'RealName', realname)
+            ds('create', path, 'UniqueID', uid)
+            ds('create', path, 'PrimaryGroupID', gid)
+            ds('create', path, 'UserShell', '/bin/bash')
+            ds('create', path, 'NFSHomeDirectory', path)
+            ds('passwd', path, a['password'])
+            usernames.append(username)
 
-    return get_info(username)
+    for username in usernames:
+        path = '/Users/' + username
+        call('/usr/bin/ditto', USER_TEMPLATE + 'English.lproj/', path)
+        call('/usr/bin/ditto', USER_TEMPLATE + 'Non_localized/', path)
+        call('/usr/sbin/chown', '-R', username + ':staff', path)
+
+    return usernames
 
 
 def hide_user(username, hide_home=True):
@@ -88,7 +267,7 @@ def hide_user(username, hide_home=True):
     dscl('create', path, 'IsHidden', '1')
 
     if hide_home:
-        subprocess.call(['/usr/bin/chflags', 'hidden', path])
+        call('/usr/bin/chflags', 'hidden', path)
 
 
 def delete_user(username, delete_home=True):
@@ -2,15 +2,52 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import time
+import json
 import logging
+import shutil
+import plistlib
+import tempfile
 import subprocess
-from unittest import main, skip, TestCase
+from unittest import main, mock, skip, TestCase
 
 from machammer import (functions, system_profiler,
                        network, hooks, users,
                        screensaver, defaults,
-                       printers, process,)
+                       printers, process, runner,
+                       instrument, tasks, installer,
+                       apps, applescript,)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.append(FIXTURES)
+
+
+def temp_dir(test):
+    """Return a new temporary directory, removed when test is done."""
+    path = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, path, True)
+    return path
+
+
+def patch(test, target, **values):
+    """Set attributes of target (or keys, if it's a dict) to values
+    until test is done."""
+    if isinstance(target, dict) or target is os.environ:
+        p = mock.patch.dict(target, values)
+    else:
+        p = mock.patch.multiple(target, **values)
+
+    p.start()
+    test.addCleanup(p.stop)
+
+
+def fake_profiler(test):
+    """Run system_profiler from the stand-in in fixtures/ with fresh
+    caches until test is done."""
+    patch(test, system_profiler, _types=None, _profiles={}, _indexes={},
+          PROFILER_PATH=os.path.join(FIXTURES, 'system_profiler'))
+    patch(test, system_profiler.cache, root=temp_dir(test))
 
 
 class DefaultsTestCase(TestCase):
@@ -27,6 +64,179 @@ class DefaultsTestCase(TestCase):
         finder.prefs.ShowPathbar = False
 
 
+class DomainTestCase(TestCase):
+    def setUp(self):
+        patch(self, defaults, PREFERENCES_DIR=temp_dir(self))
+        self.path = defaults.domain_path('com.example')
+        with open(self.path, 'wb') as f:
+            plistlib.dump({'a': 1, 'b': 2}, f)
+
+    def test_domain_path(self):
+        self.assertEqual(defaults.domain_path('/Library/LaunchDaemons/x'),
+                         '/Library/LaunchDaemons/x.plist')
+        self.assertTrue(defaults.domain_path('NSGlobalDomain').endswith('/.GlobalPreferences.plist'))
+
+    def test_changes(self):
+        d = defaults.Domain('com.example')
+        d['c'] = 3
+        del d['a']
+        self.assertEqual(d.as_dict(), {'b': 2, 'c': 3})
+        self.assertEqual(d.changes, {'a': None, 'c': 3})
+        self.assertEqual(defaults.read_plist(self.path)[0], {'a': 1, 'b': 2})
+
+        with self.assertRaises(KeyError):
+            d['a']
+
+    def test_save(self):
+        r = runner.ReplayRunner()
+
+        with runner.use(r):
+            with defaults.Domain('com.example') as d:
+                d.update(c=3, b=4)
+            # someone else changes the domain meanwhile
+            other = defaults.Domain('com.example')
+            other['d'] = 4
+            other.save()
+            d['e'] = 5
+            self.assertTrue(d.save())
+            self.assertFalse(d.save())
+
+        self.assertEqual(defaults.read_plist(self.path),
+                         ({'a': 1, 'b': 4, 'c': 3, 'd': 4, 'e': 5}, plistlib.FMT_XML))
+
+    def test_owner(self):
+        if os.getuid() != 0:
+            self.skipTest('needs root')
+
+        os.chown(self.path, 1234, 5678)
+        os.chmod(self.path, 0o600)
+        defaults.write_plist(self.path, {'a': 2})
+        st = os.stat(self.path)
+        self.assertEqual((st.st_uid, st.st_gid, st.st_mode & 0o777), (1234, 5678, 0o600))
+
+    def test_new(self):
+        d = defaults.Domain('com.example.new')
+        d['a'] = True
+        d.save()
+        self.assertEqual(defaults.read_plist(d.path), ({'a': True}, plistlib.FMT_BINARY))
+
+
+class TransactionTestCase(TestCase):
+    def setUp(self):
+        self.root = temp_dir(self)
+        patch(self, defaults, PREFERENCES_DIR=self.root)
+        self.path = defaults.domain_path('com.example.a')
+        with open(self.path, 'wb') as f:
+            plistlib.dump({'a': 1}, f)
+
+    def test_commit(self):
+        with defaults.transaction() as t:
+            t.set('com.example.a', 'b', 2)
+            t.set('com.example.b', 'a', 1)
+            t.delete('com.example.a', 'a')
+
+        self.assertEqual(defaults.read_plist(self.path)[0], {'b': 2})
+        self.assertEqual(defaults.Domain('com.example.b').as_dict(), {'a': 1})
+
+    def test_rollback(self):
+        with self.assertRaises(ZeroDivisionError):
+            with defaults.transaction() as t:
+                t.set('com.example.a', 'b', 2)
+                1 / 0
+
+        t = defaults.transaction()
+        t.set('com.example.a', 'b', 2)
+        t.set('com.example.new', 'a', 1)
+        t.set(os.path.join(self.root, 'missing', 'c'), 'c', 3)
+
+        with self.assertRaises(OSError):
+            t.commit()
+
+        self.assertEqual(defaults.read_plist(self.path)[0], {'a': 1})
+        self.assertFalse(os.path.exists(defaults.domain_path('com.example.new')))
+        self.assertEqual(t.domain('com.example.a').changes, {})
+
+    def test_rollback_owner(self):
+        if os.getuid() != 0:
+            self.skipTest('needs root')
+
+        os.chown(self.path, 1234, 5678)
+        t = defaults.transaction()
+        t.set('com.example.a', 'b', 2)
+        t.set(os.path.join(self.root, 'missing', 'c'), 'c', 3)
+
+        with self.assertRaises(OSError):
+            t.commit()
+
+        st = os.stat(self.path)
+        self.assertEqual((st.st_uid, st.st_gid), (1234, 5678))
+        self.assertEqual(defaults.read_plist(self.path)[0], {'a': 1})
+
+    def test_hooks(self):
+        patch(self, hooks, LAUNCH_DAEMONS=self.root)
+
+        with instrument.enabled() as stats:
+            hooks.mount('/Volumes/Backup', '/usr/local/bin/backup')
+
+        path = defaults.domain_path(os.path.join(self.root, 'com.github.filipp.machammer.mounthook'))
+        self.assertEqual(defaults.read_plist(path)[0]['WatchPaths'], ['/Volumes/Backup'])
+        self.assertEqual(stats.commands, [])
+
+        hooks.mount('/Volumes/Backup')
+        self.assertFalse(os.path.exists(path))
+
+
+class ApplyTestCase(TestCase):
+    settings = {'com.example.a': {'a': True, 'b': [1, 2], 'c': None},
+                'com.example.b': {'x': 'y'}}
+
+    def setUp(self):
+        patch(self, defaults, PREFERENCES_DIR=temp_dir(self))
+        with open(defaults.domain_path('com.example.a'), 'wb') as f:
+            plistlib.dump({'a': 1, 'b': [1, 2], 'c': 'gone'}, f)
+
+    def test_same(self):
+        self.assertFalse(defaults.same(1, True))
+        self.assertFalse(defaults.same({'a': [1]}, {'a': [1.0]}))
+        self.assertTrue(defaults.same({'a': [1]}, {'a': [1]}))
+
+    def test_files(self):
+        changes = defaults.apply(self.settings, files=True)
+        self.assertEqual([(c.domain, c.key, c.old, c.new) for c in changes],
+                         [('com.example.a', 'a', 1, True),
+                          ('com.example.a', 'c', 'gone', None),
+                          ('com.example.b', 'x', None, 'y')])
+        self.assertEqual(defaults.Domain('com.example.a').as_dict(), {'a': True, 'b': [1, 2]})
+
+        mtime = os.stat(defaults.domain_path('com.example.a')).st_mtime_ns
+        self.assertEqual(defaults.apply(self.settings, files=True), [])
+        self.assertEqual(os.stat(defaults.domain_path('com.example.a')).st_mtime_ns, mtime)
+
+    def test_dry_run(self):
+        self.assertEqual(len(defaults.apply(self.settings, files=True, dry_run=True)), 3)
+        self.assertEqual(defaults.Domain('com.example.a')['a'], 1)
+
+    def test_defaults(self):
+        r = runner.ReplayRunner()
+        r.add([defaults.DEFAULTS_PATH, 'export', 'com.example.a', '-'],
+              plistlib.dumps({'a': True, 'b': [1, 2], 'c': 'gone'}).decode())
+        r.add([defaults.DEFAULTS_PATH, 'export', 'com.example.b', '-'],
+              plistlib.dumps({'x': 'z', 'other': 1}).decode())
+        r.add([defaults.DEFAULTS_PATH, 'delete', 'com.example.a', 'c'])
+        r.add([defaults.DEFAULTS_PATH, 'write', 'com.example.b', 'x', '<string>y</string>'])
+
+        with runner.use(r):
+            changes = defaults.apply(self.settings)
+
+        self.assertEqual([c.key for c in changes], ['c', 'x'])
+
+    def test_plist_literal(self):
+        self.assertEqual(defaults.plist_literal(True), '<true/>')
+        self.assertEqual(defaults.plist_literal(1.5), '<real>1.5</real>')
+        self.assertEqual(plistlib.loads(('<plist>%s</plist>' % defaults.plist_literal({'a': [1]})).encode()),
+                         {'a': [1]})
+
+
 class UsersTestCase(TestCase):
     def test_nextid(self):
         self.assertGreater(users.nextid(), 1)
@@ -44,6 +254,232 @@ class UsersTestCase(TestCase):
         users.delete_user('test.user')
 
 
+class DsclSessionTestCase(TestCase):
+    """Runs against the dscl stand-in in fixtures/"""
+    def setUp(self):
+        self.tmp = temp_dir(self)
+        self.log = os.path.join(self.tmp, 'log')
+        patch(self, os.environ, MH_DSCL_DB=os.path.join(self.tmp, 'db.json'), MH_DSCL_LOG=self.log)
+        patch(self, users, DSCL_PATH=os.path.join(FIXTURES, 'dscl'))
+
+    def calls(self):
+        with open(self.log) as f:
+            return f.read().strip().split('\n')
+
+    def test_session(self):
+        with users.DsclSession() as ds:
+            ds('create', '/Users/test.user')
+            ds('create', '/Users/test.user', 'RealName', 'Test "The" User')
+        self.assertEqual(len(self.calls()), 1)
+        self.assertIn('Test "The" User', users.dscl('read', '/Users/test.user').decode())
+
+    def test_session_error(self):
+        with self.assertRaises(Exception):
+            with users.DsclSession() as ds:
+                ds('delete', '/Users/nonexistent')
+
+    def test_create_users(self):
+        accounts = [{'realname': 'Lab User %d' % i, 'password': 'pw %d' % i}
+                    for i in range(10)]
+        calls = []
+
+        class Runner(runner.SubprocessRunner):
+            def run(self, argv, input=None, capture=True):
+                calls.append(argv[0])
+                if argv[0] == users.DSCL_PATH:
+                    return runner.SubprocessRunner.run(self, argv, input, capture)
+                return runner.Result(argv, 0, b'', b'')
+
+        # only the dscl stand-in runs, no need to be root
+        patch(self, os, getuid=lambda: 0)
+
+        with runner.use(Runner()):
+            names = users.create_users(accounts)
+
+        self.assertEqual(names[0], 'lab.user.0')
+        self.assertEqual(calls.count(users.DSCL_PATH), 2)
+        self.assertEqual(max(users.get_ids()), 511)
+
+
+class IdAllocatorTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.ReplayRunner()
+        self.runner.add(['/usr/bin/dscl', '.', '-list', '/Users', 'UniqueID'],
+                        'root 0\nnobody -2\na 501\nb 502\nc 504\nd 510\ne\n')
+
+    def test_next(self):
+        with runner.use(self.runner):
+            ids = users.IdAllocator()
+            self.assertEqual([ids.next(), ids.next()], [511, 512])
+            self.assertEqual(users.nextid(), 511)
+
+    def test_fill_gaps(self):
+        with runner.use(self.runner):
+            ids = users.IdAllocator(start=501, fill_gaps=True, reserved=[(505, 508)])
+            ids.add(503)
+            self.assertEqual([ids.next() for _ in range(3)], [509, 511, 512])
+            self.assertIn(503, ids)
+            self.assertEqual(len(self.runner.results), 1)
+
+        with self.assertRaises(ValueError):
+            users.IdAllocator(fill_gaps=True)
+
+    def test_reserved(self):
+        with runner.use(self.runner):
+            ids = users.IdAllocator(start=600, reserved=[(600, 699)])
+            self.assertEqual(ids.next(), 700)
+
+
+class TasksTestCase(TestCase):
+    def sh(self, script):
+        return functions.call('/bin/sh', '-c', script)
+
+    def test_parallel(self):
+        ex = tasks.Executor(max_workers=4)
+        for i in range(4):
+            ex.add('sleep%d' % i, self.sh, 'sleep 0.5')
+        start = time.time()
+        results = ex.run()
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(set(t.status for t in results.values()), set([tasks.DONE]))
+
+    def test_order(self):
+        done = []
+        ex = tasks.Executor()
+        ex.add('install', lambda: done.append('install') or self.sh('sleep 0.2'))
+        ex.add('configure', done.append, 'configure', after=['install'])
+        ex.run()
+        self.assertEqual(done, ['install', 'configure'])
+
+    def test_errors(self):
+        ex = tasks.Executor()
+        ex.add('fail', functions.check_output, '/bin/sh', '-c', 'exit 1')
+        ex.add('dependent', self.sh, 'true', after=['fail'])
+        ex.add('independent', self.sh, 'true')
+        results = ex.run()
+        self.assertEqual(results['fail'].status, tasks.FAILED)
+        self.assertEqual(results['dependent'].status, tasks.SKIPPED)
+        self.assertEqual(results['independent'].status, tasks.DONE)
+        self.assertEqual(sorted(ex.errors()), ['dependent', 'fail'])
+
+    def test_exit_status(self):
+        ex = tasks.Executor()
+        ex.add('install', self.sh, 'exit 1')
+        ex.add('configure', self.sh, 'true', after=['install'])
+        ex.add('anything', self.sh, 'exit 2', check=None)
+        ex.add('count', len, [1, 2], check=lambda r: r == 2)
+        results = ex.run()
+        self.assertEqual((results['install'].status, results['install'].result), (tasks.FAILED, 1))
+        self.assertEqual(results['configure'].status, tasks.SKIPPED)
+        self.assertEqual(results['anything'].status, tasks.DONE)
+        self.assertEqual(results['count'].status, tasks.DONE)
+
+    def test_cycle(self):
+        ex = tasks.Executor()
+        ex.add('a', self.sh, 'true', after=['b'])
+        ex.add('b', self.sh, 'true', after=['a'])
+        with self.assertRaises(ValueError):
+            ex.run()
+
+
+class AioTestCase(TestCase):
+    def run_async(self, coro):
+        import asyncio
+        return asyncio.run(coro)
+
+    def test_concurrent(self):
+        import asyncio
+        from machammer import aio
+
+        async def main():
+            return await asyncio.gather(*[aio.check_output('/bin/sh', '-c', 'sleep 0.5; echo %d' % i)
+                                          for i in range(20)])
+
+        start = time.time()
+        results = self.run_async(main())
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(results[3], b'3')
+
+    def test_errors(self):
+        from machammer import aio
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_async(aio.check_output('/bin/sh', '-c', 'exit 1'))
+        with self.assertRaises(Exception):
+            self.run_async(aio.popen(['/bin/sh', '-c', 'echo oops >&2']))
+        self.assertEqual(self.run_async(aio.call('/bin/sh', '-c', 'exit 3')), 3)
+
+    def test_network(self):
+        from machammer.aio import network as anetwork
+        ports = (network.Port('Ethernet', 'en4', 'Ethernet'), network.Port('Thunderbolt', 'en3', 'Ethernet'),
+                 network.Port('Wi-Fi', 'en0', 'AirPort'))
+        patch(self, network, _snapshot=network.Snapshot(ports, {'en4': False, 'en3': True, 'en0': True},
+                                                         'en0', True, 'lalalala', time.time()))
+
+        self.assertEqual(self.run_async(anetwork.get_primary(ttl=60)), 'en0')
+        self.assertTrue(self.run_async(anetwork.is_wired(ttl=60)))
+        self.assertFalse(self.run_async(anetwork.is_wired(primary=True, ttl=60)))
+        self.assertIs(self.run_async(anetwork.snapshot(60)), network._snapshot)
+
+    def test_network_mac(self):
+        from machammer.aio import network as anetwork
+        fake_profiler(self)
+        system_profiler.SystemProfile('Network')
+        patch(self, network, SYS_NET='/nonexistent', _snapshot=None)
+
+        r = runner.ReplayRunner()
+        r.add(['/sbin/ifconfig'], NetworkSnapshotTestCase.IFCONFIG)
+        r.add(['/sbin/route', '-n', 'get', 'default'], '   route to: default\n  interface: en0\n')
+        r.add(['/usr/sbin/networksetup', '-getcomputername'], 'lalalala\n')
+        r.add(['/usr/sbin/networksetup', '-getairportpower', 'en0'], 'Wi-Fi Power (en0): On\n')
+
+        with runner.use(r):
+            s = self.run_async(anetwork.snapshot())
+            self.assertIs(network.snapshot(60), s)
+            self.assertEqual(self.run_async(anetwork.get_primary(ttl=60)), 'en0')
+            self.assertFalse(self.run_async(anetwork.is_wired(ttl=60)))
+            self.assertEqual([p['interface'] for p in self.run_async(anetwork.get_ports())], ['en4', 'en3'])
+
+        self.assertEqual((s.computer_name, s.wifi_power), ('lalalala', True))
+
+    def test_cancel(self):
+        import asyncio
+        from machammer import aio
+        pidfile = os.path.join(temp_dir(self), 'pid')
+
+        async def main():
+            await asyncio.wait_for(aio.run(['/bin/sh', '-c', 'echo $$ > %s; exec sleep 10' % pidfile]), 0.5)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(main())
+
+        with open(pidfile) as f:
+            pid = int(f.read())
+
+        with self.assertRaises(OSError):
+            os.kill(pid, 0)
+
+    def test_replay(self):
+        from machammer import aio
+        from machammer.aio import network as anetwork, defaults as adefaults, users as ausers
+        r = runner.ReplayRunner()
+        r.add(['/usr/sbin/networksetup', '-getcomputername'], 'lalalala\n')
+        r.add(['/usr/bin/defaults', 'domains'], 'com.apple.a, com.apple.b\n')
+        r.add(['/usr/bin/dscl', '.', '-list', '/Users', 'UniqueID'], 'root 0\nuser 501\n')
+        r.add(['/usr/bin/osascript', '-e', 'tell application "Say \\"Hi\\"" to quit'])
+
+        with runner.use(r):
+            self.assertEqual(self.run_async(anetwork.get_computer_name()), b'lalalala')
+            self.assertEqual(self.run_async(adefaults.domains()), ['com.apple.a', 'com.apple.b'])
+            self.assertEqual(self.run_async(ausers.nextid()), 502)
+            self.assertIsNone(self.run_async(aio.tell_app('Say "Hi"', 'quit')))
+
+        r = runner.ReplayRunner()
+        r.add(['/usr/bin/dscl', '.', '-list', '/Groups', 'PrimaryGroupID'], '')
+
+        with runner.use(r):
+            self.assertEqual(self.run_async(ausers.nextid('/Groups', 'PrimaryGroupID')), 0)
+
+
 class PrintersTestCase(TestCase):
     def test_delete_printers(self):
         printers.delete_printers()
@@ -67,6 +503,133 @@ class ProcessTestCase(TestCase):
         self.assertTrue(process.is_active(self.appname))
 
 
+class ProcessTableTestCase(TestCase):
+    def setUp(self):
+        patch(self, process, _snapshot=None)
+
+    def test_ps(self):
+        app = os.path.join(FIXTURES, 'installer', 'Example.app', 'Contents', 'MacOS', 'Example')
+        r = runner.ReplayRunner()
+        r.add([process.PS_PATH, '-axww', '-o', 'pid=,uid=,user=,comm='],
+              '    1     0 root     /sbin/launchd\n'
+              '  501   501 admin    %s\n'
+              '  502   501 admin    /Applications/Microsoft Word.app/Contents/MacOS/Microsoft Word\n'
+              '  503     0 root     kernel_task\n' % app)
+        patch(self, process, PROC_DIR='/nonexistent')
+
+        with runner.use(r):
+            table = process.snapshot(ttl=0)
+
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.pid(1).name, 'launchd')
+        self.assertEqual(table.named('Microsoft Word')[0].user, 'admin')
+        self.assertEqual([p.pid for p in table.bundle('com.example.app')], [501])
+        self.assertEqual(process.pidof('Example'), [501])
+        self.assertTrue(process.is_running('kernel_task'))
+        self.assertFalse(process.is_running('Safari'))
+
+    def test_proc(self):
+        if not os.path.isdir('/proc/self'):
+            self.skipTest('no /proc')
+
+        me = process.snapshot(ttl=0).pid(os.getpid())
+        self.assertEqual(me.uid, os.getuid())
+        self.assertIn(os.getpid(), process.pidof(me.name))
+
+    def test_ttl(self):
+        table = process.snapshot(60)
+        self.assertIs(process.snapshot(60), table)
+        self.assertIsNot(process.snapshot(0), table)
+
+
+class WaitTestCase(TestCase):
+    def spawn(self, seconds):
+        return subprocess.Popen(['sleep', str(seconds)])
+
+    def test_exit(self):
+        proc = self.spawn(0.2)
+        start = time.time()
+        self.assertTrue(process.wait_for_exit(proc.pid, 5))
+        self.assertLess(time.time() - start, 2)
+        proc.wait()
+
+    def test_timeout(self):
+        proc = self.spawn(5)
+        self.assertFalse(process.wait_for_exit([proc.pid], 0.1))
+        proc.kill()
+        proc.wait()
+        self.assertTrue(process.wait_for_exit(proc.pid, 1))
+
+    def test_poll(self):
+        import threading
+        proc = self.spawn(0.2)
+        # reap it, or it would look alive to kill(pid, 0)
+        threading.Thread(target=proc.wait).start()
+        self.assertTrue(process._wait_poll([proc.pid], time.time() + 5))
+
+    def test_launch(self):
+        if not os.path.isdir('/proc/self'):
+            self.skipTest('no /proc')
+
+        self.assertEqual(process.wait_for_launch('no-such-process', 0.1), [])
+        proc = self.spawn(5)
+        self.assertIn(proc.pid, process.wait_for_launch('sleep', 1))
+        proc.kill()
+        proc.wait()
+
+    def test_kill(self):
+        proc = subprocess.Popen([sys.executable, '-c', 'import signal, time; '
+                                 'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                                 'print(1, flush=True); time.sleep(10)'], stdout=subprocess.PIPE)
+        proc.stdout.readline()
+        r = runner.ReplayRunner()
+        r.add(['/usr/bin/killall', '-TERM', 'stubborn'])
+        patch(self, process, snapshot=lambda ttl=0: process.ProcessTable([process.Proc(proc.pid, 0, 'root', 'stubborn')]))
+
+        start = time.time()
+        with runner.use(r):
+            self.assertTrue(process.kill('stubborn', timeout=0.2))
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(proc.wait(), -9)
+
+    def test_launch_backoff(self):
+        reads = []
+        patch(self, process, snapshot=lambda ttl=0: reads.append(ttl) or process.ProcessTable([]))
+        start = time.time()
+        self.assertEqual(process.wait_for_launch('nothing', 1), [])
+        self.assertLess(time.time() - start, 1.5)
+        self.assertLessEqual(len(reads), 6)
+
+
+class PrefsTestCase(TestCase):
+    def setUp(self):
+        patch(self, defaults, PREFERENCES_DIR=temp_dir(self))
+        with open(defaults.domain_path('com.apple.finder'), 'wb') as f:
+            plistlib.dump({'ShowPathbar': True, 'ShowStatusBar': False}, f)
+        self.prefs = process.Prefs('com.apple.finder', process.FileBackend)
+
+    def test_get(self):
+        self.assertEqual(self.prefs.ShowPathbar, True)
+        self.assertEqual(self.prefs['ShowStatusBar'], False)
+        self.assertEqual(list(self.prefs), ['ShowPathbar', 'ShowStatusBar'])
+        self.assertIsNone(self.prefs.get('Missing'))
+
+        with self.assertRaises(AttributeError):
+            self.prefs.Missing
+
+    def test_set(self):
+        self.prefs.ShowPathbar = False
+        self.prefs.update(ShowStatusBar=True, NewWindowTarget='PfHm')
+        del self.prefs['ShowStatusBar']
+
+        prefs = process.Prefs('com.apple.finder', process.FileBackend)
+        self.assertEqual(prefs.keys(), ['NewWindowTarget', 'ShowPathbar'])
+        self.assertEqual(dict(prefs), {'ShowPathbar': False, 'NewWindowTarget': 'PfHm'})
+
+        with self.assertRaises(AttributeError):
+            prefs.domain = 'com.apple.dock'
+
+
 class SystemProfilerTestCase(TestCase):
     def testSerialNumber(self):
         sn = system_profiler.get('Hardware', 'serial_number')
@@ -96,6 +659,192 @@ class SystemProfilerTestCase(TestCase):
         self.assertTrue(build in system_profiler.get('Software', 'os_version'))
 
 
+class ProfileBatchTestCase(TestCase):
+    """Runs against the system_profiler stand-in in fixtures/"""
+    def setUp(self):
+        self.log = os.path.join(temp_dir(self), 'log')
+        patch(self, os.environ, MH_PROFILER_LOG=self.log)
+        fake_profiler(self)
+
+    def calls(self):
+        with open(self.log) as f:
+            return f.read().strip().split('\n')
+
+    def test_load_many(self):
+        p = system_profiler.SystemProfile.load_many(['Hardware', 'Network', 'Storage'])
+        self.assertEqual(p['Hardware'].machine_model, 'MacBookPro14,1')
+        self.assertEqual(len(p['Network'].find('type', 'Ethernet')), 2)
+        self.assertEqual(len(self.calls()), 2)
+
+    def test_shared_cache(self):
+        system_profiler.SystemProfile.load_many(['Hardware', 'Network'])
+        system_profiler.SystemProfile('Hardware')
+        system_profiler.SystemProfile('Network')
+        system_profiler.SystemProfile('Storage')
+        self.assertEqual(self.calls(), ['-listDataTypes',
+            'SPHardwareDataType SPNetworkDataType -detaillevel full -xml',
+            'SPStorageDataType -detaillevel full -xml'])
+
+    def test_iterparse(self):
+        from machammer.plist import iterparse
+        path = os.path.join(FIXTURES, 'SPNetworkDataType.xml')
+        with open(path, 'rb') as f:
+            expected = plistlib.load(f)[0]['_items']
+        with open(path, 'rb') as f:
+            items = list(iterparse(f))
+        self.assertEqual(items, [('SPNetworkDataType', x) for x in expected])
+
+    def test_cache_not_ours(self):
+        os.chmod(system_profiler.cache.root, 0o777)
+        p = system_profiler.SystemProfile('Hardware')
+        self.assertEqual(p.machine_model, 'MacBookPro14,1')
+        system_profiler.SystemProfile.load_many(['Hardware', 'Network'])
+
+    def test_stream(self):
+        p = system_profiler.SystemProfile('Network', stream=True)
+        self.assertEqual(len(p.find('type', 'Ethernet')), 2)
+        self.assertEqual(p.interface, 'en0')
+        self.assertEqual(len(self.calls()), 3)
+
+    def test_find_indexed(self):
+        p = system_profiler.SystemProfile('Network')
+        self.assertEqual([x['interface'] for x in p.filter(type='Ethernet')], ['en4', 'en3'])
+        self.assertEqual(len(p.find('_name', 'Thunderbolt')), 2)
+        self.assertEqual(len(p.find('_name', 'Thunderbolt', 'startswith')), 2)
+        self.assertEqual(len(p.find('_name', 'Wi-Fi', 'exact')), 1)
+        self.assertEqual(len(p.find('ip_address', '10.0.0.20')), 1)
+
+    def test_index_invalidate(self):
+        p = system_profiler.SystemProfile('Network')
+        p.filter(type='Ethernet')
+        self.assertIn('Network', system_profiler._indexes)
+        system_profiler.invalidate('Network')
+        self.assertNotIn('Network', system_profiler._indexes)
+
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        from machammer.cache import FileCache
+        self.cache = FileCache(temp_dir(self), ttl=60, ttls={'Network': 0}, stale=60)
+
+    def test_set_get(self):
+        self.cache.set('Hardware', [{'a': 1}])
+        self.assertEqual(self.cache.get('Hardware'), ([{'a': 1}], True))
+        self.assertEqual(os.listdir(self.cache.root), ['Hardware.cache'])
+
+    def test_ttl(self):
+        self.cache.set('Network', [])
+        self.assertIsNone(self.cache.get('Network'))
+        self.assertEqual(self.cache.get('Network', stale=True), ([], False))
+
+    def test_version(self):
+        from machammer import cache
+        self.cache.set('Hardware', [])
+        cache.VERSION += 1
+        try:
+            self.assertIsNone(self.cache.get('Hardware'))
+        finally:
+            cache.VERSION -= 1
+
+    def test_corrupt(self):
+        self.cache.set('Hardware', [])
+        with open(self.cache.path('Hardware'), 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(self.cache.get('Hardware'))
+
+    def test_not_ours(self):
+        self.cache.set('Hardware', [])
+        os.chmod(self.cache.path('Hardware'), 0o666)
+        self.assertIsNone(self.cache.get('Hardware'))
+
+        os.chmod(self.cache.path('Hardware'), 0o600)
+        os.chmod(self.cache.root, 0o777)
+        self.assertIsNone(self.cache.get('Hardware'))
+        self.cache.set('Hardware', [1])
+        with self.cache.lock('Hardware'):
+            pass
+        self.assertFalse(os.path.exists(os.path.join(self.cache.root, 'Hardware.lock')))
+
+        os.chmod(self.cache.root, 0o700)
+        self.assertEqual(self.cache.get('Hardware'), ([], True))
+
+    def test_planted(self):
+        import pickle
+        with open(self.cache.path('Hardware'), 'wb') as f:
+            pickle.dump({'version': 1, 'key': 'Hardware', 'created': time.time(), 'value': []}, f)
+        self.assertIsNone(self.cache.get('Hardware'))
+
+
+class RunnerTestCase(TestCase):
+    def test_record_replay(self):
+        path = os.path.join(temp_dir(self), 'record.json')
+        recorder = runner.RecordingRunner()
+
+        with runner.use(recorder):
+            self.assertEqual(functions.check_output('/bin/echo', 'hello'), b'hello')
+            self.assertEqual(functions.call('/bin/sh', '-c', 'exit 3'), 3)
+
+        recorder.save(path)
+
+        with runner.use(runner.ReplayRunner(path)):
+            self.assertEqual(functions.check_output('/bin/echo', 'hello'), b'hello')
+            self.assertEqual(functions.call('/bin/sh', '-c', 'exit 3'), 3)
+            with self.assertRaises(Exception):
+                functions.call('/bin/echo', 'not recorded')
+
+    def test_replay(self):
+        r = runner.ReplayRunner()
+        r.add(['/usr/sbin/networksetup', '-getcomputername'], 'lalalala\n')
+        r.add(['/usr/bin/defaults', 'domains'], 'com.apple.a, com.apple.b\n')
+        r.add(['/usr/bin/dscl', '.', '-list', '/Users', 'UniqueID'], 'root 0\nuser 501\n')
+
+        with runner.use(r):
+            self.assertEqual(network.get_computer_name(), b'lalalala')
+            self.assertEqual(defaults.domains(), ['com.apple.a', 'com.apple.b'])
+            self.assertEqual(users.nextid(), 502)
+
+    def test_check_output_error(self):
+        r = runner.ReplayRunner()
+        r.add(['/bin/false'], returncode=1)
+
+        with runner.use(r):
+            with self.assertRaises(subprocess.CalledProcessError):
+                functions.check_output('/bin/false')
+
+
+class InstrumentTestCase(TestCase):
+    def setUp(self):
+        self.runner = runner.ReplayRunner()
+        self.runner.add(['/usr/sbin/networksetup', '-getcomputername'], 'lalalala')
+        self.runner.add(['/usr/bin/osascript', '-e', 'tell application "Finder" to sleep'])
+
+    def test_disabled(self):
+        self.assertIsNone(instrument.stats)
+
+    def test_report(self):
+        with runner.use(self.runner):
+            with instrument.enabled() as stats:
+                network.get_computer_name()
+                functions.sleep()
+            network.get_computer_name()
+
+        self.assertEqual(len(stats.commands), 2)
+        self.assertEqual(stats.commands[0].caller, 'network.get_computer_name')
+        self.assertEqual(sorted(x[0] for x in stats.group('module')), ['functions', 'network'])
+        self.assertIn('osascript', stats.report())
+
+    def test_profiler_counters(self):
+        fake_profiler(self)
+
+        with instrument.enabled() as stats:
+            system_profiler.SystemProfile('Storage')
+            system_profiler.SystemProfile('Storage')
+
+        self.assertEqual(stats.counters['system_profiler.miss'], 1)
+        self.assertEqual(stats.counters['system_profiler.memory_hit'], 1)
+        self.assertEqual(stats.timings['system_profiler.load'][0], 2)
+
+
 class NetworkTestCase(TestCase):
     def test_get_computer_name(self):
         name = network.get_computer_name()
@@ -127,6 +876,63 @@ class NetworkTestCase(TestCase):
         self.assertTrue(network.is_wired(True))
 
 
+class NetworkSnapshotTestCase(TestCase):
+    IFCONFIG = """lo0: flags=8049<UP,LOOPBACK,RUNNING,MULTICAST> mtu 16384
+\tinet 127.0.0.1 netmask 0xff000000
+en0: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tether 8c:85:90:00:00:01
+\tstatus: active
+en4: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tstatus: inactive
+en3: flags=8822<BROADCAST,SMART,SIMPLEX,MULTICAST> mtu 1500
+"""
+
+    def setUp(self):
+        patch(self, network, _snapshot=None)
+
+    def test_parse(self):
+        self.assertEqual(network.parse_ifconfig(self.IFCONFIG.encode()),
+                         {'lo0': True, 'en0': True, 'en4': False, 'en3': False})
+        route = b'Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\tMask\n' \
+                b'eth1\t000200C0\t00000000\t0001\t0\t0\t0\t00FFFFFF\n' \
+                b'eth1\t00000000\t010200C0\t0003\t0\t0\t0\t00000000\n'
+        self.assertEqual(network.parse_proc_route(route), 'eth1')
+
+    def test_mac(self):
+        fake_profiler(self)
+        system_profiler.SystemProfile('Network')
+        patch(self, network, SYS_NET='/nonexistent')
+
+        r = runner.ReplayRunner()
+        r.add(['/sbin/ifconfig'], self.IFCONFIG)
+        r.add(['/sbin/route', '-n', 'get', 'default'], '   route to: default\n  interface: en0\n')
+        r.add(['/usr/sbin/networksetup', '-getcomputername'], 'lalalala\n')
+        r.add(['/usr/sbin/networksetup', '-getairportpower', 'en0'], 'Wi-Fi Power (en0): On\n')
+
+        with runner.use(r):
+            s = network.snapshot()
+            self.assertIs(network.snapshot(60), s)
+            self.assertTrue(network.is_wireless())
+            self.assertFalse(network.is_wired(primary=True))
+            self.assertEqual(network.get_primary(), 'en0')
+            self.assertTrue(network.get_wifi_power())
+
+        self.assertEqual(s.computer_name, 'lalalala')
+        self.assertEqual([p.interface for p in s.ports if p.type == 'Ethernet'], ['en4', 'en3'])
+
+        with self.assertRaises(TypeError):
+            s.active['en4'] = True
+
+    def test_linux(self):
+        if not os.path.isdir(network.SYS_NET):
+            self.skipTest('no /sys/class/net')
+
+        import socket
+        s = network.snapshot()
+        self.assertEqual(sorted(p.interface for p in s.ports), sorted(os.listdir(network.SYS_NET)))
+        self.assertEqual(s.computer_name, socket.gethostname())
+
+
 class VersionsTestCase(TestCase):
     def setUp(self):
         self.profile = system_profiler.SystemProfile('Applications')
@@ -217,6 +1023,351 @@ class MountTestCase(TestCase):
         self.assertFalse(os.path.exists(self.image))
 
 
+class DownloadTestCase(TestCase):
+    """Runs against the local HTTP server in fixtures/"""
+    def setUp(self):
+        import hashlib
+        import server
+        from machammer import download, integrity
+        patch(self, integrity, _index=integrity.Index(temp_dir(self)))
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.server = server.serve({'/a.dmg': self.data, '/b.pkg': self.data[:1000]})
+        self.url = self.server.url + '/a.dmg'
+        self.downloader = download.Downloader(temp_dir(self))
+        patch(self, download, _downloader=self.downloader)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_cache(self):
+        with functions.fetch(self.url, cache=True) as path:
+            self.assertEqual(self.read(path), self.data)
+        with functions.fetch(self.url, cache=True) as path2:
+            self.assertEqual(path, path2)
+        self.assertIn('If-None-Match', self.server.requests[-1][1])
+
+    def test_sha256(self):
+        from machammer import download
+        self.downloader.get(self.url, self.sha256)
+        self.downloader.get(self.server.url + '/other', self.sha256.upper())
+        self.assertEqual(len(self.server.requests), 1)
+        with self.assertRaises(download.ChecksumError):
+            self.downloader.get(self.server.url + '/b.pkg', 'f' * 64)
+
+    def test_sha256_revalidate(self):
+        from machammer import download
+        self.downloader.get(self.url)
+        with self.assertRaises(download.ChecksumError):
+            self.downloader.get(self.url, 'f' * 64)
+        self.assertNotIn('If-None-Match', self.server.requests[-1][1])
+
+    def test_resume(self):
+        self.server.drop_after = 1024 * 1024
+        self.server.drops = 2
+        path = self.downloader.get(self.url, self.sha256)
+        self.assertEqual(self.read(path), self.data)
+        ranges = [h.get('Range') for _, h in self.server.requests]
+        self.assertEqual(ranges, [None, 'bytes=1048576-', 'bytes=2097152-'])
+
+    def test_segments(self):
+        self.server.drop_after = 100000
+        self.server.drops = 3
+        with functions.fetch(self.url, sha256=self.sha256, segments=4) as path:
+            self.assertEqual(self.read(path), self.data)
+        ranges = set(h.get('Range') for _, h in self.server.requests)
+        self.assertIn('bytes=0-0', ranges)
+        self.assertIn('bytes=786437-1572873', ranges)
+
+    def test_segments_sha256(self):
+        from machammer import download
+        self.downloader.get(self.url, segments=4)
+        with self.assertRaises(download.ChecksumError):
+            self.downloader.get(self.url, 'f' * 64, segments=4)
+
+    def test_segments_empty(self):
+        from machammer import download
+        self.server.files['/empty'] = b''
+        path = self.downloader.get(self.server.url + '/empty', segments=4)
+        self.assertEqual(self.read(path), b'')
+
+        fd, tmp = tempfile.mkstemp()
+        self.addCleanup(os.unlink, tmp)
+        download.preallocate(fd, 0)
+        os.close(fd)
+
+    def test_segments_revalidate(self):
+        path = self.downloader.get(self.url, segments=4)
+        self.assertEqual(self.downloader.get(self.url, segments=4), path)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_many(self):
+        paths = functions.fetch_many([self.url, self.server.url + '/b.pkg'])
+        self.assertEqual(self.read(paths[1]), self.data[:1000])
+
+
+class IntegrityTestCase(TestCase):
+    def setUp(self):
+        import hashlib
+        from machammer import integrity
+        self.index = integrity.Index(temp_dir(self))
+        patch(self, integrity, _index=self.index)
+        self.path = os.path.join(temp_dir(self), 'data')
+        with open(self.path, 'wb') as f:
+            f.write(os.urandom(5 * 1024 * 1024 + 3))
+        with open(self.path, 'rb') as f:
+            self.sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    def test_hash(self):
+        from machammer import integrity
+        self.assertEqual(integrity.hash_file(self.path), self.sha256)
+        self.assertEqual(integrity.hash_file(self.path, use_mmap=False), self.sha256)
+
+    def test_index(self):
+        from machammer import integrity
+        integrity.verify(self.path, self.sha256)
+        self.assertEqual(self.index.get(self.path), self.sha256)
+        with open(self.path, 'ab') as f:
+            f.write(b'x')
+        self.assertIsNone(self.index.get(self.path))
+        with self.assertRaises(integrity.ChecksumError):
+            integrity.verify(self.path, self.sha256)
+
+    def test_install_pkg(self):
+        from machammer import integrity
+        r = runner.ReplayRunner()
+        r.add(['/usr/sbin/installer', '-pkg', self.path, '-target', '/'])
+
+        with runner.use(r):
+            self.assertEqual(functions.install_pkg(self.path, sha256=self.sha256), 0)
+            with self.assertRaises(integrity.ChecksumError):
+                functions.install_pkg(self.path, sha256='0' * 64)
+
+
+class PlannerTestCase(TestCase):
+    """Plans against the fixture receipts and apps in fixtures/installer"""
+    def setUp(self):
+        self.root = os.path.join(FIXTURES, 'installer')
+        self.planner = installer.Planner(os.path.join(self.root, 'receipts'),
+                                         os.path.join(self.root, 'Applications'))
+
+    def fixture(self, name):
+        return os.path.join(self.root, name)
+
+    def test_pkg_info(self):
+        self.assertEqual(installer.pkg_info(self.fixture('Example.pkg')),
+                         [('com.example.pkg', '2.1.0')])
+        self.assertEqual(installer.pkg_info(self.fixture('Product.pkg')),
+                         [('com.example.pkg', '2.1.0'), ('com.example.helper', '1.0')])
+
+    def test_versions(self):
+        v = installer.parse_version
+        self.assertLess(v('3.1.4'), v('3.2'))
+        self.assertLess(v('10.9'), v('10.10'))
+        self.assertEqual(v('2.1.0'), v('2.1.0'))
+
+    def test_plan(self):
+        import zipfile
+        path = os.path.join(temp_dir(self), 'Example.zip')
+        with zipfile.ZipFile(path, 'w') as z:
+            z.write(self.fixture('Applications/Example.app/Contents/Info.plist'),
+                    'Example.app/Contents/Info.plist')
+
+        self.planner.pkg(self.fixture('Example.pkg'))
+        self.planner.pkg(self.fixture('Product.pkg'))
+        self.planner.app(self.fixture('Example.app'))
+        self.planner.zip(path)
+        self.planner.dmg('/tmp/Example.dmg', 'Example.pkg', 'com.example.pkg', '2.2')
+        actions = [s.action for s in self.planner.plan()]
+        self.assertEqual(actions, [installer.NOOP, installer.INSTALL, installer.UPGRADE,
+                                   installer.NOOP, installer.UPGRADE])
+
+    def test_run(self):
+        r = runner.ReplayRunner()
+        r.add(['/usr/sbin/installer', '-pkg', self.fixture('Product.pkg'), '-target', '/'])
+        r.add(['/usr/bin/rsync', '-auE', self.fixture('Example.app'), self.fixture('Applications') + '/'])
+        self.planner.pkg(self.fixture('Example.pkg'))
+        self.planner.pkg(self.fixture('Product.pkg'))
+        self.planner.app(self.fixture('Example.app'))
+
+        steps = self.planner.plan()
+
+        with runner.use(r):
+            steps = self.planner.run(steps)
+
+        self.assertEqual([s.result for s in steps], [None, 0, 0])
+
+
+class InventoryTestCase(TestCase):
+    def setUp(self):
+        self.root = temp_dir(self)
+        for path in ('Example.app', 'Utilities/Tool.app', 'Folder/Broken.app'):
+            os.makedirs(os.path.join(self.root, path, 'Contents'))
+        self.write('Example.app', 'com.example.app', '1.0')
+        self.write('Utilities/Tool.app', 'com.example.tool', '2.0')
+
+    def write(self, app, identifier, version):
+        with open(os.path.join(self.root, app, 'Contents', 'Info.plist'), 'wb') as f:
+            plistlib.dump({'CFBundleIdentifier': identifier,
+                           'CFBundleShortVersionString': version}, f)
+
+    def test_inventory(self):
+        result = apps.inventory([self.root])
+        self.assertEqual([(b.name, b.version) for b in result],
+                         [('Example', '1.0'), ('Tool', '2.0')])
+        self.assertEqual(apps.find('com.example.tool', [self.root])[0].name, 'Tool')
+
+    def test_rescan(self):
+        apps.inventory([self.root])
+        self.write('Example.app', 'com.example.app', '1.1')
+
+        with instrument.enabled() as stats:
+            result = apps.inventory([self.root])
+
+        self.assertEqual(stats.counters['functions.plist_miss'], 1)
+        self.assertEqual(result[0].version, '1.1')
+
+
+class AppleScriptSessionTestCase(TestCase):
+    def setUp(self):
+        self.log = os.path.join(temp_dir(self), 'log')
+        patch(self, os.environ, MH_OSASCRIPT_LOG=self.log, MH_OSASCRIPT_RESULTS=json.dumps({
+            'tell application "System Events" to name of every application process contains "Finder"': 'true'}))
+        self.argv = [os.path.join(FIXTURES, 'osascript')]
+
+    def scripts(self):
+        with open(self.log) as f:
+            return [json.loads(x) for x in f]
+
+    def test_run(self):
+        with applescript.Session(self.argv) as s:
+            self.assertEqual(s.run('return "a \\"b\\""'), 'a "b"')
+            self.assertEqual(s.run('return {"a", {1, 2}}'), ['a', ['1', '2']])
+            self.assertIsNone(s.run('beep'))
+
+            with self.assertRaises(applescript.ScriptError):
+                s.run('error "Nope"')
+
+    def test_functions(self):
+        with instrument.enabled() as stats:
+            with applescript.session(self.argv):
+                for _ in range(5):
+                    self.assertEqual(functions.tell_app('System Events', 'name of every application process contains "Finder"'), b'true')
+                self.assertEqual(functions.osascript('return {"a", "b"}'), b'a, b')
+
+        self.assertEqual(stats.commands, [])
+        self.assertEqual(stats.counters['applescript.start'], 1)
+
+    def test_timeout(self):
+        with applescript.Session(self.argv, timeout=0.2) as s:
+            with self.assertRaises(applescript.Timeout):
+                s.run('delay 5')
+            self.assertEqual(s.run('return 1'), '1')
+
+    def test_defer(self):
+        with applescript.Session(self.argv) as s:
+            s.defer('Safari', 'quit')
+            s.defer('Safari', 'activate')
+            s.defer('Mail', 'quit')
+            s.run('return 1')
+
+        self.assertEqual(self.scripts(), ['tell application "Safari"\n    quit\n    activate\nend tell\n'
+                                          'tell application "Mail"\n    quit\nend tell',
+                                          'return 1'])
+
+    def test_quote(self):
+        self.assertEqual(applescript.quote('a "b" \\c'), '"a \\"b\\" \\\\c"')
+
+
+class AppleScriptBatchTestCase(TestCase):
+    def test_literal(self):
+        self.assertEqual(applescript.literal({'name': 'a "b"', 'hidden': True, 'items': [1, None]}),
+                         '{hidden:true, items:{1, missing value}, name:"a \\"b\\""}')
+
+    def test_results(self):
+        scripts = []
+
+        def execute(script):
+            scripts.append(script)
+            return 'ok:Flurry\x1eerror:Nope\x1eok:'
+
+        b = applescript.Batch('System Events', execute, raise_errors=False)
+        name = b.get('name of current screen saver')
+        failed = b.run('delete login item %s', 'x')
+        b.run('start current screen saver')
+        self.assertEqual(len(b.send()), 3)
+
+        self.assertEqual(len(scripts), 1)
+        self.assertIn('delete login item "x"', scripts[0])
+        self.assertEqual((name.value, name.error), ('Flurry', None))
+        self.assertEqual(failed.error, 'Nope')
+
+        with self.assertRaises(applescript.ScriptError):
+            with applescript.Batch('System Events', execute) as b:
+                b.get('name of current screen saver')
+                b.run('delete login item %s', 'x')
+                b.run('start current screen saver')
+
+    def test_login_items(self):
+        b = functions.applescript_batch('System Events')
+        b.run('make login item at end with properties %s',
+              {'path': '/Applications/"Q".app', 'hidden': True, 'name': '"Q".app'})
+        b.run('make login item at end with properties %s',
+              {'path': '/Applications/B.app', 'hidden': True, 'name': 'B.app'})
+
+        r = runner.ReplayRunner()
+        r.add(['/usr/bin/osascript', '-e', b.script], 'ok:\x1eok:')
+
+        with runner.use(r):
+            users.add_login_items(['/Applications/"Q".app', '/Applications/B.app'])
+
+
+class PlistTestCase(TestCase):
+    def setUp(self):
+        self.tmp = temp_dir(self)
+
+    def write(self, name, data, fmt=None):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            plistlib.dump(data, f, fmt=fmt or plistlib.FMT_XML)
+        return path
+
+    def test_formats(self):
+        xml = self.write('xml.plist', {'a': 1})
+        binary = self.write('binary.plist', {'a': 1}, plistlib.FMT_BINARY)
+        self.assertEqual(functions.get_plist(xml), {'a': 1})
+        self.assertEqual(functions.get_plist(binary), {'a': 1})
+
+    def test_legacy(self):
+        path = os.path.join(self.tmp, 'old.plist')
+        with open(path, 'w') as f:
+            f.write('{ a = 1; }')
+        r = runner.ReplayRunner()
+        r.add(['/usr/bin/plutil', '-convert', 'xml1', path, '-o', '-'],
+              '<plist version="1.0"><dict><key>a</key><string>1</string></dict></plist>')
+        with runner.use(r):
+            self.assertEqual(functions.get_plist(path), {'a': '1'})
+
+        empty = os.path.join(self.tmp, 'empty.plist')
+        open(empty, 'w').close()
+        r.add(['/usr/bin/plutil', '-convert', 'xml1', empty, '-o', '-'], '')
+        with runner.use(r):
+            self.assertIsNone(functions.get_plist(empty))
+
+    def test_cache(self):
+        paths = [self.write('%d.plist' % i, {'i': i}) for i in range(3)]
+        first = functions.get_plists(paths, cache=True)
+        self.assertIs(functions.get_plists(paths, cache=True)[paths[0]], first[paths[0]])
+        self.write('0.plist', {'i': 'changed'})
+        os.utime(paths[0], (0, 0))
+        self.assertEqual(functions.get_plists(paths, cache=True)[paths[0]], {'i': 'changed'})
+
+
 class FunctionsTestCase(TestCase):
     def setUp(self):
         self.url = os.getenv('MH_URL')
@@ -250,6 +1401,13 @@ class ScreenSaverTestCase(TestCase):
         with self.assertRaises(Exception):
             screensaver.set('Blalala')
 
+    def test_set_quoted(self):
+        r = runner.ReplayRunner()
+        r.add(['/usr/bin/osascript', '-e', 'tell application "System Events" to '
+               'set current screen saver to (get screen saver named "My \\"Saver\\"")'])
+        with runner.use(r):
+            self.assertIsNone(screensaver.set('My "Saver"'))
+
     def test_set_flurry(self):
         self.assertEquals(screensaver.set('Flurry'), None)
 